@@ -1,19 +1,24 @@
 import sys
 import os
 import re
+import html
 import logging
 import uuid
 import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
+from requests.adapters import HTTPAdapter
 import arrow
-from bs4 import BeautifulSoup
+import pymongo
 from PIL import Image
 
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 
 import models
+from alerts.parse_cap import parse_cap
 
 sys.path.append(sys.path[0] + "/..")
 
@@ -26,6 +31,122 @@ HEADERS = {
 }
 
 ALERTS_MAP_URL = "http://alert-as.inmet.gov.br/cv/"
+ALERTS_RSS_URL = "https://apiprevmet3.inmet.gov.br/avisos/rss"
+
+# Patterns used to filter the RSS feed's items without building a tree
+RSS_ITEM_PATTERN = re.compile(rb"<item(?:\s[^>]*)?>(.*?)</item>", re.DOTALL)
+RSS_GUID_PATTERN = re.compile(rb"<guid[^>]*>\s*(.*?)\s*</guid>", re.DOTALL)
+RSS_SEVERITY_PATTERN = re.compile(rb"Severidade Grau: ([^<]*?)\s*</title>")
+RSS_END_DATE_PATTERN = re.compile(
+    rb"Fim(?:</th>|&lt;/th&gt;)\s*(?:<td>|&lt;td&gt;)(\d{4}-\d{2}-\d{2} \d\d:\d\d:\d\d\.\d)"
+)
+
+# Number of alert XMLs (CAP documents) downloaded concurrently
+ALERTS_FETCH_WORKERS = 8
+# Timeout (in seconds) for each alert XML request
+ALERTS_FETCH_TIMEOUT = 10
+
+
+def create_session(poolSize=ALERTS_FETCH_WORKERS):
+    """Create a `requests.Session` whose connection pool can hold `poolSize` connections."""
+
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Shared session, so connections to INMET are reused across requests
+alertsSession = create_session()
+
+
+class AlertsFeed:
+    """The AlertsFeed object keeps track of INMET's RSS feed between fetches, so that an unchanged feed isn't processed again.
+
+    The validators and hash of a changed feed are only kept once `commit` is called (i.e. after its alerts were ingested), so a feed whose ingest failed is processed again on the next fetch.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the RSS feed.
+
+    Attributes
+    ----------
+    etag : str
+        The ETag header of the last committed response.
+    lastModified : str
+        The Last-Modified header of the last committed response.
+    contentHash : str
+        SHA-256 hash of the items of the last committed feed.
+    changed : bool
+        Whether the feed changed in the last fetch.
+    skippedCycles : int
+        Number of fetches in which the feed was unchanged.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.etag = None
+        self.lastModified = None
+        self.contentHash = None
+        self.changed = True
+        self.skippedCycles = 0
+        self.pendingValidators = None
+
+    def get_conditional_headers(self):
+        """Get the headers for a conditional GET request to the feed."""
+
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.lastModified:
+            headers["If-Modified-Since"] = self.lastModified
+        return headers
+
+    def update(self, response):
+        """Hold the validators and content hash from `response` until `commit` is called (right away if the feed hasn't changed). Return True if the feed has changed."""
+
+        if response.status_code == 304:
+            self.changed = False
+        else:
+            # Only hash the items, since channel metadata (e.g. lastBuildDate) may change on every request
+            content = response.content
+            itemsStart = max(content.find(b"<item"), 0)
+            contentHash = hashlib.sha256(content[itemsStart:]).hexdigest()
+            self.changed = contentHash != self.contentHash
+            self.pendingValidators = (
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                contentHash,
+            )
+
+        if not self.changed:
+            self.commit()
+            self.skippedCycles += 1
+            parsingLogger.info(
+                f"Alerts RSS is unchanged; skipping ({self.skippedCycles} cycles skipped so far)."
+            )
+        return self.changed
+
+    def commit(self):
+        """Keep the validators and content hash of the last fetch, so that the feed isn't processed again until it changes."""
+
+        if self.pendingValidators:
+            self.etag, self.lastModified, self.contentHash = self.pendingValidators
+            self.pendingValidators = None
+
+    def invalidate(self):
+        """Forget the last feed, so that the next fetch is processed even if the feed hasn't changed."""
+
+        self.etag = None
+        self.lastModified = None
+        self.contentHash = None
+        self.pendingValidators = None
+
+
+alertsFeed = AlertsFeed(ALERTS_RSS_URL)
 
 
 def take_screenshot_alerts_map():
@@ -95,12 +216,14 @@ def parse_alerts(ignoreModerate=True):
     return alerts
 
 
-def is_wanted_alert(alertXML, ignoreModerate=True):
-    """Check if alert is wanted - an alert is wanted if it's not already present in the database, endDate has not already passed and the alert isn't moderate if `ignoreModerate` is set to `True`.
+def is_wanted_alert(alertItem, ignoreModerate=True):
+    """Check if alert is wanted from its RSS item - an alert is wanted if its endDate has not already passed and the alert isn't moderate if `ignoreModerate` is set to `True`.
+
+    Whether the alert is already present in the database is checked later, in batch, by `filter_unknown_guids` and `filter_new_alerts`.
 
     Parameters
     --------
-        alert: the alert's XML parsed from BS4.
+        alertItem: the raw content of the alert's RSS item.
         ignoreModerate: if set to True, will ignore alerts of moderate severity. Defaults to True.
 
     Returns
@@ -108,39 +231,105 @@ def is_wanted_alert(alertXML, ignoreModerate=True):
         True if alert is wanted, False otherwise.
     """
 
-    brazilTime = arrow.utcnow().to("Brazil/East")
-
-    severityPattern = r"(?<=Severidade Grau: )(.*)(?=<\/title)"
-    severityMatch = re.search(severityPattern, str(alertXML))
+    severityMatch = RSS_SEVERITY_PATTERN.search(alertItem)
     if severityMatch:
         severity = severityMatch.group(1)
-        if severity == "Moderate" and ignoreModerate:
+        if severity == b"Moderate" and ignoreModerate:
             return False
     else:
         parsingLogger.error("No severity match.")
 
-    endDatePattern = r"Fim<\/th><td>(\d{4}-\d{2}-\d{2} \d\d:\d\d:\d\d\.\d)"
-    endDateMatch = re.search(endDatePattern, str(alertXML))
+    endDateMatch = RSS_END_DATE_PATTERN.search(alertItem)
     if endDateMatch:
-        endDate = arrow.get(endDateMatch.group(1))
-        if brazilTime > endDate:
+        endDate = arrow.get(endDateMatch.group(1).decode())
+        if arrow.utcnow().to("Brazil/East") > endDate:
             return False
     else:
         parsingLogger.error("No date match.")
 
-    guidTag = alertXML.find("guid").text
-    parsedXML = parse_alert_xml(guidTag)
-    if parsedXML:
-        alertID = parsedXML.identifier.text.replace("urn:oid:", "")
-        if alertID:
-            if models.db.INMETBotDB.alertsCollection.find_one({"alertID": alertID}):
-                parsingLogger.debug("Alert already in database.")
-                return False
-            else:
-                parsingLogger.debug("New alert.")
-                return True
-    else:
-        parsingLogger.error("No parsedXML.")
+    return True
+
+
+def iter_rss_items(content):
+    """Iterate over the raw content of each item of an RSS feed, without parsing the whole feed."""
+
+    for itemMatch in RSS_ITEM_PATTERN.finditer(content):
+        yield itemMatch.group(1)
+
+
+def get_alert_id(parsedXML):
+    """Extract the alert ID from a parsed alert XML."""
+
+    return (parsedXML.identifier or "").replace("urn:oid:", "")
+
+
+def filter_unknown_guids(xmlURLs):
+    """Filter out alert XML URLs (RSS items' guids) of alerts already in the database, with a single query.
+
+    Parameters
+    --------
+    xmlURLs : list : str
+        URLs to the XML files.
+
+    Returns
+    --------
+    unknownXMLURLs : list : str
+        URLs of alerts that aren't in the database.
+    """
+
+    knownGuids = {
+        alert["guid"]
+        for alert in models.db.INMETBotDB.alertsCollection.find(
+            {"guid": {"$in": xmlURLs}}, {"guid": 1, "_id": 0}
+        )
+    }
+    parsingLogger.debug(
+        f"{len(knownGuids)}/{len(xmlURLs)} alerts already in database."
+    )
+    return [xmlURL for xmlURL in xmlURLs if xmlURL not in knownGuids]
+
+
+def filter_new_alerts(alertsDocuments):
+    """Filter out parsed alert XMLs whose alert ID is already in the database, with a single query.
+
+    Alerts stored before guids were saved can only be matched by ID; their guid is saved so they are filtered by `filter_unknown_guids` from then on.
+
+    Parameters
+    --------
+    alertsDocuments : dict
+        parsed alert XMLs keyed by their URL (guid).
+
+    Returns
+    --------
+    newAlertsDocuments : dict
+        parsed alert XMLs of new alerts keyed by their URL (guid).
+    """
+
+    alertIDs = {
+        guid: get_alert_id(parsedXML) for guid, parsedXML in alertsDocuments.items()
+    }
+    knownAlertIDs = {
+        alert["alertID"]
+        for alert in models.db.INMETBotDB.alertsCollection.find(
+            {"alertID": {"$in": list(alertIDs.values())}}, {"alertID": 1, "_id": 0}
+        )
+    }
+
+    if knownAlertIDs:
+        models.db.INMETBotDB.alertsCollection.bulk_write(
+            [
+                pymongo.UpdateOne({"alertID": alertID}, {"$set": {"guid": guid}})
+                for guid, alertID in alertIDs.items()
+                if alertID in knownAlertIDs
+            ],
+            ordered=False,
+        )
+
+    return {
+        guid: parsedXML
+        for guid, parsedXML in alertsDocuments.items()
+        if alertIDs[guid] and alertIDs[guid] not in knownAlertIDs
+    }
 
 
 def instantiate_alerts_objects(alertsXML, ignoreModerate=True):
@@ -148,17 +337,24 @@ def instantiate_alerts_objects(alertsXML, ignoreModerate=True):
 
     Parameters
     --------
+    alertsXML : dict
+        parsed alert XMLs keyed by their URL (guid), such as the ones returned by `parse_alerts_xml`.
     ignoreModerate : bool
         If set to True, will ignore alerts of moderate severity. Defaults to True.
     """
 
     if alertsXML:
-        return [models.Alert.Alert(alertXML) for alertXML in alertsXML]
+        return [
+            models.Alert.Alert(capRecord=alertXML, guid=guid)
+            for guid, alertXML in alertsXML.items()
+        ]
 
 
 def parse_alerts_xml(ignoreModerate=True):
     """Parse XMLs from list of XML urls.
 
+    Alerts already in the database are filtered out by their guid before any XML is downloaded, and each remaining XML is downloaded and parsed only once per call: the parsed documents are kept in a cache keyed by the RSS item's guid, which is used both to filter out alerts already in the database and to build `Alert` objects.
+
     Parameters
     --------
     ignoreModerate : bool
@@ -166,40 +362,94 @@ def parse_alerts_xml(ignoreModerate=True):
 
     Returns
     --------
-    xmls : list : BeautifulSoup
-        list of parsed XMLs.
+    xmls : dict
+        parsed XMLs of new alerts keyed by their URL (guid).
     """
 
     xmlURLs = get_alerts_xml(ignoreModerate)
     if xmlURLs:
-        xmls = [parse_alert_xml(xmlURL) for xmlURL in xmlURLs]
+        xmlURLs = filter_unknown_guids(xmlURLs)
+        alertsDocuments = dict(fetch_alerts_xml(xmlURLs))
+        if len(alertsDocuments) < len(xmlURLs):
+            # Process the feed again next cycle so that failed downloads are retried
+            alertsFeed.invalidate()
+        xmls = filter_new_alerts(alertsDocuments) if alertsDocuments else {}
         parsingLogger.debug("Done parsing XMLs.")
         return xmls
     else:
         return None
 
 
-def parse_alert_xml(xmlURL):
-    """Parse alerts XML URL from INMET with BeautifulSoup.
+def fetch_alerts_xml(
+    xmlURLs, maxWorkers=ALERTS_FETCH_WORKERS, timeout=ALERTS_FETCH_TIMEOUT
+):
+    """Download and parse alert XMLs concurrently.
+
+    Parameters
+    --------
+    xmlURLs : list : str
+        URLs to the XML files.
+    maxWorkers : int
+        Maximum number of simultaneous downloads. Defaults to `ALERTS_FETCH_WORKERS`.
+    timeout : int
+        Timeout (in seconds) for each request. Defaults to `ALERTS_FETCH_TIMEOUT`.
+
+    Yields
+    --------
+    (xmlURL, parsedAlertXML) : tuple
+        URL and parsed XML of each alert, in completion order. Failed downloads are skipped.
+    """
+
+    startTime = time.perf_counter()
+    nParsed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            futures = {
+                executor.submit(parse_alert_xml, xmlURL, alertsSession, timeout): xmlURL
+                for xmlURL in xmlURLs
+            }
+            for future in as_completed(futures):
+                parsedAlertXML = future.result()
+                if parsedAlertXML:
+                    nParsed += 1
+                    yield (futures[future], parsedAlertXML)
+    finally:
+        elapsedTime = time.perf_counter() - startTime
+        parsingLogger.info(
+            f"Parsed {nParsed}/{len(xmlURLs)} alert XMLs in {elapsedTime:.2f}s ({maxWorkers} workers)."
+        )
+
+
+def parse_alert_xml(xmlURL, session=alertsSession, timeout=ALERTS_FETCH_TIMEOUT):
+    """Parse alerts XML URL from INMET with `parse_cap`.
 
     Parameters
     --------
     xmlURL : str
         URL to the XML file.
+    session : Session
+        `requests.Session` used for the request. Defaults to the shared `alertsSession`.
+    timeout : int
+        Timeout (in seconds) for the request. Defaults to `ALERTS_FETCH_TIMEOUT`.
 
     Returns
     --------
-    parsedAlertXML : BeautifulSoup
-        parsed XML or None if GET request to XML URL fails.
+    parsedAlertXML : CAPRecord
+        parsed XML or None if GET request to XML URL or parsing fails.
     """
 
-    req = requests.get(xmlURL, headers=HEADERS, allow_redirects=False)
+    try:
+        req = session.get(xmlURL, allow_redirects=False, timeout=timeout)
+    except requests.exceptions.RequestException as error:
+        parsingLogger.error(f"Failed GET request to alert XML {xmlURL}: {error}")
+        return None
+
     if req.status_code == 200:
         parsingLogger.info("Successful GET request to alert XML!")
 
         # Retrieve the XML content
         content = req.content
-        parsedAlertXML = BeautifulSoup(content, "xml")
+        parsedAlertXML = parse_cap(content)
         return parsedAlertXML
     else:
         parsingLogger.error("Failed GET request to alert XML.")
@@ -217,24 +467,34 @@ def get_alerts_xml(ignoreModerate=True):
     Returns
     --------
     itemsXMLURL : list : str
-        List of all available XML URLs for alerts.
+        List of all available XML URLs for alerts. Empty if the feed hasn't changed since the last call.
     """
 
-    ALERTS_URL = "https://apiprevmet3.inmet.gov.br/avisos/rss"
-    req = requests.get(ALERTS_URL, headers=HEADERS, allow_redirects=False)
-    if req.status_code == 200:
-        parsingLogger.info("Successful GET request to alerts RSS!")
+    try:
+        req = alertsSession.get(
+            alertsFeed.url,
+            headers=alertsFeed.get_conditional_headers(),
+            allow_redirects=False,
+            timeout=ALERTS_FETCH_TIMEOUT,
+        )
+    except requests.exceptions.RequestException as error:
+        parsingLogger.error(f"Failed GET request to alerts RSS: {error}")
+        return None
 
-        # Retrieve the RSS feed content
-        content = req.content
-        xml = BeautifulSoup(content, "html.parser")
-        # parsingLogger.debug(xml)
+    if req.status_code in (200, 304) and not alertsFeed.update(req):
+        return []
+    elif req.status_code == 200:
+        parsingLogger.info("Successful GET request to alerts RSS!")
 
-        # Get alerts' XML URL from each item entry
-        items = xml.channel.find_all("item")
-        itemsXMLURLs = [
-            item.guid.text for item in items if is_wanted_alert(item, ignoreModerate)
-        ]
+        # Get alerts' XML URL from each wanted item entry
+        itemsXMLURLs = []
+        for item in iter_rss_items(req.content):
+            if is_wanted_alert(item, ignoreModerate):
+                guidMatch = RSS_GUID_PATTERN.search(item)
+                if guidMatch:
+                    itemsXMLURLs.append(html.unescape(guidMatch.group(1).decode()))
+                else:
+                    parsingLogger.error("No guid match.")
 
         return itemsXMLURLs
     else:
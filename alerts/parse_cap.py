@@ -0,0 +1,175 @@
+import sys
+import time
+import logging
+from io import BytesIO
+from collections import namedtuple
+
+from lxml import etree
+from bs4 import BeautifulSoup
+
+capLogger = logging.getLogger(__name__)
+capLogger.setLevel(logging.DEBUG)
+
+
+# Fields of a CAP 1.2 document used by the bot (only the first <info> block is considered)
+CAPRecord = namedtuple(
+    "CAPRecord",
+    [
+        "identifier",
+        "event",
+        "headline",
+        "severity",
+        "onset",
+        "expires",
+        "description",
+        "areaDesc",
+        "municipalities",
+        "polygons",
+    ],
+)
+
+# Elements of the <info> block whose text is copied as is to the record
+INFO_FIELDS = (
+    "event",
+    "headline",
+    "severity",
+    "onset",
+    "expires",
+    "description",
+    "areaDesc",
+)
+
+
+def parse_cap(content):
+    """Parse a CAP 1.2 document with lxml in a single pass.
+
+    Elements are matched by their local name, so the document's namespace doesn't matter, and they are discarded as soon as they are read.
+
+    Parameters
+    --------
+    content : bytes
+        The XML document.
+
+    Returns
+    --------
+    record : CAPRecord
+        The alert's fields, or None if the document can't be parsed.
+    """
+
+    identifier = None
+    fields = dict.fromkeys(INFO_FIELDS)
+    municipalities = None
+    polygons = []
+    valueName = ""
+
+    try:
+        for _, element in etree.iterparse(BytesIO(content), events=("end",)):
+            tag = element.tag
+            tag = tag[tag.rfind("}") + 1 :]
+
+            if tag == "identifier":
+                identifier = element.text
+            elif tag in fields:
+                if fields[tag] is None:
+                    fields[tag] = element.text
+            elif tag == "valueName":
+                valueName = element.text or ""
+            elif tag == "value":
+                # <geocode> and <eventCode> also have valueName/value pairs
+                parentTag = element.getparent().tag
+                if parentTag.endswith("parameter") and "Municipio" in valueName:
+                    municipalities = element.text
+            elif tag == "polygon":
+                polygons.append(element.text)
+            elif tag == "info":
+                # Ignore any other <info> blocks
+                break
+
+            element.clear()
+    except etree.XMLSyntaxError as error:
+        capLogger.error(f"Unable to parse CAP document: {error}")
+        return None
+
+    return CAPRecord(
+        identifier=identifier,
+        municipalities=municipalities,
+        polygons=polygons,
+        **fields,
+    )
+
+
+def record_from_soup(alertXML):
+    """Create a CAPRecord from a BS4-parsed CAP document."""
+
+    info = alertXML.info
+
+    municipalities = None
+    for parameter in info.find_all("parameter"):
+        if "Municipio" in parameter.valueName.text:
+            municipalities = parameter.value.text
+
+    fields = {}
+    for field in INFO_FIELDS:
+        element = info.find(field)
+        fields[field] = element.text if element is not None else None
+
+    return CAPRecord(
+        identifier=alertXML.identifier.text,
+        municipalities=municipalities,
+        polygons=[polygon.text for polygon in info.find_all("polygon")],
+        **fields,
+    )
+
+
+def benchmark(documents, repeat=20):
+    """Compare parsing `documents` with lxml (`parse_cap`) against BeautifulSoup (`record_from_soup`).
+
+    Parameters
+    --------
+    documents : list : bytes
+        Recorded CAP documents.
+    repeat : int
+        Number of times each document is parsed by each parser. Defaults to 20.
+
+    Returns
+    --------
+    timings : dict
+        Average time (in milliseconds) per document for each parser.
+    """
+
+    parsers = {
+        "BeautifulSoup": lambda content: record_from_soup(
+            BeautifulSoup(content, "xml")
+        ),
+        "lxml": parse_cap,
+    }
+
+    timings = {}
+    for parserName, parser in parsers.items():
+        startTime = time.perf_counter()
+        for _ in range(repeat):
+            for content in documents:
+                parser(content)
+        elapsedTime = time.perf_counter() - startTime
+        timings[parserName] = elapsedTime * 1000 / (repeat * len(documents))
+
+    # Both parsers must extract the same fields
+    for content in documents:
+        if parsers["BeautifulSoup"](content) != parsers["lxml"](content):
+            capLogger.warning("Parsers disagree on a document.")
+
+    return timings
+
+
+if __name__ == "__main__":
+    # Usage: python -m alerts.parse_cap <recorded CAP documents...>
+    documents = []
+    for path in sys.argv[1:]:
+        with open(path, "rb") as capFile:
+            documents.append(capFile.read())
+
+    if documents:
+        for parserName, timing in benchmark(documents).items():
+            print(f"{parserName}: {timing:.3f} ms/document ({len(documents)} documents)")
+    else:
+        print("Usage: python -m alerts.parse_cap <recorded CAP documents...>")
@@ -2,32 +2,49 @@
 
 import arrow
 import logging
+import queue
+import threading
+
+from telegram.error import Unauthorized, BadRequest
 
 from alerts import parse_alerts
 
 from models.db import INMETBotDB
 from models.Alert import Alert
+from models import Notification, CityChats, Outbox
 
-from utils import viacep, bot_messages
+from utils.delivery import DeliveryEngine
 from bot_config import updater
 
 routinesLogger = logging.getLogger(__name__)
 routinesLogger.setLevel(logging.DEBUG)
 
+# Number of outbox jobs leased and sent at a time
+OUTBOX_BATCH_SIZE = 100
+
+# IDs of alerts inserted by parse_alerts_routine, published so chats can be notified right away
+newAlertsQueue = queue.Queue()
+# Keep the notifier thread and the periodic routines from fanning out the same alerts, or sending the same jobs, at once
+# (reentrant, since the scheduler holds them while running the routines that acquire them too)
+notifyLock = threading.RLock()
+sendLock = threading.RLock()
+
+deliveryEngine = DeliveryEngine(updater.bot)
+
 
 def delete_past_alerts_routine():
-    """Delete past alerts published by INMET from the database."""
+    """Delete past alerts published by INMET from the database.
+
+    MongoDB already expires alerts through the TTL index on endDate, but its monitor only runs every minute or so; this removes any leftovers with a single indexed query.
+    """
     routinesLogger.info("Starting delete_past_alerts_routine routine.")
 
-    alerts = list(INMETBotDB.alertsCollection.find({}))
-    timeNow = arrow.utcnow().to("Brazil/East")
-    for alert in alerts:
-        if timeNow > arrow.get(alert["endDate"]):
-            routinesLogger.info(
-                f"alert {alert['alertID']} is past and will be deleted."
-            )
-            INMETBotDB.alertsCollection.delete_one({"alertID": alert["alertID"]})
-    routinesLogger.info("Finished delete_past_alerts_routine routine.")
+    result = INMETBotDB.alertsCollection.delete_many(
+        {"endDate": {"$lt": arrow.utcnow().datetime}}
+    )
+    routinesLogger.info(
+        f"Finished delete_past_alerts_routine routine ({result.deleted_count} past alerts deleted)."
+    )
     return True
 
 
@@ -39,129 +56,170 @@ def parse_alerts_routine(ignoreModerate=False):
     --------
     ignoreModerate : bool
         If set to True, will ignore alerts of moderate severity. Defaults to False.
+
+    Returns
+    --------
+    changed : bool
+        True if INMET's feed changed since the last run, False otherwise.
     """
 
     routinesLogger.info("Starting parse_alerts_routine routine.")
 
     alertsXML = parse_alerts.parse_alerts_xml(ignoreModerate)
+    if not parse_alerts.alertsFeed.changed:
+        routinesLogger.info("Finished parse_alerts_routine routine (feed unchanged).")
+        return False
+
     if alertsXML:
         alerts = parse_alerts.instantiate_alerts_objects(alertsXML, ignoreModerate)
         routinesLogger.info(f"New alerts found: {alerts}")
-        for alert in alerts:
-            alert.insert_alert()
-        routinesLogger.info("Finished parse_alerts_routine routine.")
-        return True
+        insertedIDs, _ = Alert.upsert_alerts(alerts)
+        if insertedIDs:
+            newAlertsQueue.put(insertedIDs)
+
+    # Only now the feed can be skipped until it changes; if anything above raised, it is processed again next run
+    parse_alerts.alertsFeed.commit()
+    routinesLogger.info("Finished parse_alerts_routine routine.")
+    return True
 
 
-# TODO: Reduce code duplication.
-def notify_chats_routine():
+def notify_chats_routine(alertIDs=None):
     """
-    Check alerts from the database and notify chats.
+    Enqueue notifications about alerts that haven't been fanned out yet, then send them.
+
+    Starting from the alerts that are new since the last run, look up the chats subscribed to any of their cities (through the CityChats collection) and enqueue a job in the outbox for each of them with the alerts it hasn't been notified about yet. Jobs are sent by `send_notifications_routine`, which records them in the ledger once they are delivered.
+    If there are no new alerts, this costs a single query.
 
-    For every alert and chat, check if chat has been notified for that alert; if it has not, check if there is any city (obtained by CEPs in the chat's CEP list) that is included in the alert.
-    If there is, notify chat and mark chat as notified (so it won't get notified again for the same alert).
+    Parameters
+    --------
+    alertIDs : list : str
+        If given, only these alerts (e.g. just inserted by `parse_alerts_routine`) are fanned out. Defaults to all alerts that haven't been fanned out yet.
     """
 
+    with notifyLock:
+        return fan_out_alerts(alertIDs)
+
+
+def fan_out_alerts(alertIDs=None):
+    """Enqueue notifications about alerts that haven't been fanned out yet (see `notify_chats_routine`)."""
+
     routinesLogger.info("Starting notify_chats_routine routine.")
 
-    # Create a list of all subscribed chats
-    subscribedChats = list(INMETBotDB.subscribedChatsCollection.find({}))
-    # Create an empty string to store the alert message
-    alertMessage = ""
-    # Create a counter to keep track of the number of alerts
-    alertCounter = 1
-
-    for chat in subscribedChats:
-        cities = []
-        if chat["activated"]:
-            routinesLogger.debug(f"Checking chat {chat['chatID']}")
-            try:
-                cities = [viacep.get_cep_city(cep) for cep in chat["CEPs"]]
-            except Exception as error:
+    newAlertsQuery = {"fannedOut": False}
+    if alertIDs is not None:
+        newAlertsQuery["alertID"] = {"$in": list(alertIDs)}
+    newAlerts = list(INMETBotDB.alertsCollection.find(newAlertsQuery))
+    if not newAlerts:
+        routinesLogger.info("Finished notify_chats_routine routine (no new alerts).")
+        send_notifications_routine()
+        return False
+
+    newAlertsIDs = [alert["alertID"] for alert in newAlerts]
+    alertsCities = {city for alert in newAlerts for city in alert["cities"]}
+    Outbox.enqueue_alerts(newAlerts, CityChats.get_chats_cities(alertsCities))
+
+    INMETBotDB.alertsCollection.update_many(
+        {"alertID": {"$in": newAlertsIDs}}, {"$set": {"fannedOut": True}}
+    )
+    routinesLogger.info("Finished notify_chats_routine routine.")
+    send_notifications_routine()
+    return True
+
+
+def notify_new_alerts_routine():
+    """Notify chats about alerts as soon as `parse_alerts_routine` publishes them, blocking until it does.
+
+    IDs published while a previous batch was being notified are notified together.
+    """
+
+    alertIDs = list(newAlertsQueue.get())
+    while True:
+        try:
+            alertIDs.extend(newAlertsQueue.get_nowait())
+        except queue.Empty:
+            break
+
+    routinesLogger.info(f"Notifying chats about newly inserted alerts {alertIDs}.")
+    return notify_chats_routine(alertIDs)
+
+
+def send_notifications_routine():
+    """
+    Send the notifications waiting in the outbox.
+
+    Jobs are leased in batches and sent by the delivery engine. Delivered jobs are recorded in the ledger with a single bulk insert, jobs for chats that blocked the bot (or no longer exist) are dropped along with the chat, jobs whose messages Telegram rejected are dropped, and jobs that hit transient errors (network errors, timeouts, flood control) are retried later with exponential backoff.
+    If another thread is already sending, this returns right away.
+    """
+
+    if not sendLock.acquire(blocking=False):
+        # The running sender leases jobs until there are none left, so it will send any new ones too
+        routinesLogger.info("Skipping send_notifications_routine: already sending.")
+        return False
+
+    try:
+        return send_outbox_jobs()
+    finally:
+        sendLock.release()
+
+
+def send_outbox_jobs():
+    """Send the notifications waiting in the outbox (see `send_notifications_routine`)."""
+
+    routinesLogger.info("Starting send_notifications_routine routine.")
+
+    nDelivered = 0
+    jobs = Outbox.lease_jobs(OUTBOX_BATCH_SIZE)
+    while jobs:
+        stats = deliveryEngine.deliver(
+            [(job["chatID"], job["messages"][job["nSent"] :]) for job in jobs]
+        )
+
+        deliveredJobs, blockedJobs, rejectedJobs, failedJobs = [], [], [], []
+        for job, (nSent, error) in zip(jobs, stats["results"]):
+            if error is None:
+                deliveredJobs.append(job)
+            elif is_unreachable_chat_error(error):
+                blockedJobs.append((job, error))
+            elif isinstance(error, BadRequest):
+                # Telegram rejected the message itself (e.g. malformed Markdown): retrying won't help, but the chat is fine
                 routinesLogger.error(
-                    f"Unknown error when getting CEPs for chat {chat}: {error}"
-                )
-                pass
-            for cep in chat["CEPs"]:
-                try:
-                    city = viacep.get_cep_city(cep)
-                    routinesLogger.debug(f"- Checking {city}...")
-                except Exception as error:
-                    routinesLogger.warning(f"Viacep error: {error}")
-                    continue
-
-                # Get alerts, by city, that weren't notified to this chat
-                alerts = list(
-                    INMETBotDB.alertsCollection.find(
-                        {
-                            "$and": [
-                                {"cities": city},
-                                {"notifiedChats": {"$ne": chat["chatID"]}},
-                            ]
-                        }
-                    )
+                    f"Message to {job['chatID']} rejected by Telegram: {error}. Dropping job {job['_id']}."
                 )
+                rejectedJobs.append((job, error))
+            else:
+                failedJobs.append((job, nSent, error))
 
-                if alerts:
-                    # Any alerts here are to be sent to the chat,
-                    # since they affect a zip code and the chat hasn't been notified yet
-                    alertMessage = ""
-                    routinesLogger.info(f"-- Existing alert for {city}. --")
-                    for alert in alerts:
-                        if alertCounter >= bot_messages.MAX_ALERTS_PER_MESSAGE:
-                            try:
-                                updater.bot.send_message(
-                                    chat_id=chat["chatID"],
-                                    text=alertMessage,
-                                    parse_mode="markdown",
-                                    disable_web_page_preview=True,
-                                )
-                            except Exception as error:
-                                routinesLogger.error(
-                                    f"ERRO: unable to send message to {chat['chatID']} ({chat['title']}): {error}.\nRemoving chat from DB......"
-                                )
-                                INMETBotDB.subscribedChatsCollection.delete_one(
-                                    {"chatID": chat["chatID"]}
-                                )
-
-                                alertMessage = ""
-                                alertCounter = 1
-
-                        alertObj = Alert(alertDict=alert)
-
-                        affectedCities = [
-                            city for city in cities if city in alertObj.cities
-                        ]
-
-                        alertMessage += alertObj.get_alert_message(affectedCities)
-                        routinesLogger.info(
-                            f"-- Notifying chat {chat['chatID']} about alert {alert['alertID']}... --"
-                        )
-
-                        INMETBotDB.alertsCollection.update_one(
-                            {"alertID": alert["alertID"]},
-                            {"$addToSet": {"notifiedChats": chat["chatID"]}},
-                        )
-                        alertCounter += 1
-
-                    # "Footer" message after all alerts
-                    alertMessage += f"\nMais informações em {bot_messages.ALERTAS_URL}."
-
-                    try:
-                        updater.bot.send_message(
-                            chat_id=chat["chatID"],
-                            text=alertMessage,
-                            parse_mode="markdown",
-                            disable_web_page_preview=True,
-                        )
-                    except Exception as error:
-                        routinesLogger.error(
-                            f"ERRO: unable to send message to {chat['chatID']} ({chat['title']}): {error}.\nRemoving chat from DB......"
-                        )
-                        INMETBotDB.subscribedChatsCollection.delete_one(
-                            {"chatID": chat["chatID"]}
-                        )
-    routinesLogger.info("Finished notify_chats_routine routine.")
+        Notification.mark_notified(Outbox.complete_jobs(deliveredJobs))
+        Outbox.fail_jobs(failedJobs)
+        Outbox.drop_jobs(blockedJobs + rejectedJobs)
+        for job, error in blockedJobs:
+            remove_unreachable_chat(job["chatID"], error)
+
+        nDelivered += len(deliveredJobs)
+        jobs = Outbox.lease_jobs(OUTBOX_BATCH_SIZE)
+
+    routinesLogger.info(
+        f"Finished send_notifications_routine routine ({nDelivered} jobs delivered)."
+    )
+    return nDelivered > 0
+
+
+def is_unreachable_chat_error(error):
+    """Check whether `error` means the chat can't ever be sent messages (the bot was blocked or kicked, or the chat no longer exists)."""
+
+    if isinstance(error, Unauthorized):
+        return True
+    return isinstance(error, BadRequest) and "chat not found" in error.message.lower()
+
+
+def remove_unreachable_chat(chatID, error):
+    """Remove chat that couldn't be sent a message from the database."""
+
+    routinesLogger.error(
+        f"ERRO: unable to send message to {chatID}: {error}.\nRemoving chat from DB......"
+    )
+    INMETBotDB.subscribedChatsCollection.delete_one({"chatID": chatID})
+    CityChats.remove_chat(chatID)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,17 @@
 import logging
-from alerts import parse_alerts
 
 import requests
 import pycep_correios as pycep
 from telegram.ext.dispatcher import run_async
 
 from models.db import INMETBotDB
-from models.Alert import Alert
+from models.Alert import AlertRenderer
 from models.Chat import Chat
+from models import Notification, CityChats
 
 
-from utils import viacep, bot_messages, bot_utils, decorators
+from utils import viacep, bot_messages, bot_utils, decorators, message_packer
+from .command_utils import send_alerts_map_screenshot
 
 alertsFunctionsLogger = logging.getLogger(__name__)
 alertsFunctionsLogger.setLevel(logging.DEBUG)
@@ -30,8 +31,7 @@ def cmd_alerts_map(update, context):
         disable_web_page_preview=True,
     )
 
-    alertsMapPath = parse_alerts.take_screenshot_alerts_map()
-    send_alerts_map_screenshot(update, context, alertsMapPath, waitMessage)
+    send_alerts_map_screenshot(update, context, waitMessage)
 
 
 @decorators.log_command
@@ -243,10 +243,13 @@ def cmd_alerts_CEP(update, context):
                 parse_mode="markdown",
             )
 
+            # CEPs of the same city get the same messages, rendered only once
+            alertRenderer = AlertRenderer()
             # STUB:
             for cep in chat.CEPs:
                 try:
-                    city = viacep.get_cep_city(cep)
+                    # Stored when the CEP was subscribed, so viacep is only queried for CEPs subscribed before that
+                    city = chat.get_CEP_location(cep)["city"]
                     alertsFunctionsLogger.debug(f"- Checking {city}...")
                 except Exception as error:
                     alertsFunctionsLogger.warning(f"Viacep error: {error}")
@@ -257,61 +260,41 @@ def cmd_alerts_CEP(update, context):
                 if alerts:
                     # Any alerts here are to be sent to the chat,
                     # since they affect a zip code and the chat hasn't been notified yet
-                    alertCounter = 1
-                    alertMessage = ""
                     alertsFunctionsLogger.info(f"-- Existing alert for {city}. --")
+                    alertsMessages = []
                     for alert in alerts:
-                        if alertCounter >= bot_messages.MAX_ALERTS_PER_MESSAGE:
-                            try:
-                                print(
-                                    chat.id,
-                                )
-                                context.bot.send_message(
-                                    chat_id=chat.id,
-                                    text=alertMessage,
-                                    parse_mode="markdown",
-                                    disable_web_page_preview=True,
-                                )
-                            except Exception as error:
-                                alertsFunctionsLogger.error(
-                                    f"ERRO: unable to send message to {chat.id} ({chat.title}): {error}. Removing chat from DB......"
-                                )
-                                INMETBotDB.subscribedChatsCollection.delete_one(
-                                    {"chatID": chat.id}
-                                )
-
-                                alertMessage = ""
-                                alertCounter = 1
-
-                        alertObj = Alert(alertDict=alert)
-                        alertMessage += alertObj.get_alert_message(city)
+                        alertsMessages.append(
+                            alertRenderer.get_alert_message(alert, city)
+                        )
                         alertsFunctionsLogger.info(
                             f"-- Notifying chat {chat.id} about alert {alert['alertID']}... --"
                         )
 
-                        INMETBotDB.alertsCollection.update_one(
-                            {"alertID": alert["alertID"]},
-                            {"$addToSet": {"notifiedChats": chat.id}},
-                        )
-                        alertCounter += 1
+                    Notification.mark_notified(
+                        [(alert["alertID"], chat.id, alert["endDate"]) for alert in alerts]
+                    )
 
                     # "Footer" message after all alerts
-                    alertMessage += f"\nMais informações em {bot_messages.ALERTAS_URL}."
-
-                    try:
-                        context.bot.send_message(
-                            chat_id=chat.id,
-                            text=alertMessage,
-                            parse_mode="markdown",
-                            disable_web_page_preview=True,
-                        )
-                    except Exception as error:
-                        alertsFunctionsLogger.error(
-                            f"ERRO: unable to send message to {chat.id} ({chat.title}): {error}. Removing chat from DB......"
-                        )
-                        INMETBotDB.subscribedChatsCollection.delete_one(
-                            {"chatID": chat.id}
-                        )
+                    messages = message_packer.pack_messages(
+                        alertsMessages, bot_messages.moreInfoAlertAS
+                    )
+                    for alertMessage in messages:
+                        try:
+                            context.bot.send_message(
+                                chat_id=chat.id,
+                                text=alertMessage,
+                                parse_mode="markdown",
+                                disable_web_page_preview=True,
+                            )
+                        except Exception as error:
+                            alertsFunctionsLogger.error(
+                                f"ERRO: unable to send message to {chat.id} ({chat.title}): {error}. Removing chat from DB......"
+                            )
+                            INMETBotDB.subscribedChatsCollection.delete_one(
+                                {"chatID": chat.id}
+                            )
+                            CityChats.remove_chat(chat.id)
+                            break
 
             context.bot.delete_message(
                 chat_id=checkingForSubscribed.chat.id,
@@ -10,7 +10,8 @@ from telegram.ext.dispatcher import run_async
 from models.Alert import Alert
 from models.Chat import Chat
 
-from utils import viacep, bot_messages, bot_utils, decorators
+from alerts import parse_alerts
+from utils import viacep, bot_messages, bot_utils, decorators, media_cache
 
 utilsFunctionsLogger = logging.getLogger(__name__)
 utilsFunctionsLogger.setLevel(logging.DEBUG)
@@ -20,23 +21,37 @@ utilsFunctionsLogger.setLevel(logging.DEBUG)
 # @decorators.ignore_users
 @decorators.log_command
 @decorators.send_upload_photo_action
-def send_alerts_map_screenshot(update, context, alertsMapPath, waitMessage):
-    """Send the alerts map screenshot."""
-
-    context.bot.send_photo(
-        chat_id=update.effective_chat.id,
-        caption=f"Fonte: {bot_messages.ALERTAS_URL}",
-        reply_to_message_id=update.message.message_id,
-        photo=open(alertsMapPath, "rb"),
-        timeout=20000,
+def send_alerts_map_screenshot(update, context, waitMessage):
+    """Send the alerts map screenshot: by file_id if the map was already sent since the alerts last changed, or else a new screenshot (deleted afterwards)."""
+
+    alertsMapPaths = []
+
+    def load_screenshot():
+        alertsMapPath = parse_alerts.take_screenshot_alerts_map()
+        alertsMapPaths.append(alertsMapPath)
+        return open(alertsMapPath, "rb")
+
+    # The map only changes along with INMET's feed of alerts
+    alertsHash = parse_alerts.alertsFeed.contentHash
+    media_cache.mediaCache.send(
+        ("alerts_map", alertsHash) if alertsHash else None,
+        lambda photo: context.bot.send_photo(
+            chat_id=update.effective_chat.id,
+            caption=f"Fonte: {bot_messages.ALERTAS_URL}",
+            reply_to_message_id=update.message.message_id,
+            photo=photo,
+            timeout=20000,
+        ),
+        load_screenshot,
     )
 
     context.bot.delete_message(
         chat_id=waitMessage.chat.id, message_id=waitMessage.message_id
     )
 
-    os.remove(alertsMapPath)
-    utilsFunctionsLogger.info(f"Deleted {alertsMapPath}.")
+    for alertsMapPath in alertsMapPaths:
+        os.remove(alertsMapPath)
+        utilsFunctionsLogger.info(f"Deleted {alertsMapPath}.")
 
 
 @run_async
@@ -5,10 +5,9 @@ import logging
 import telegram
 import arrow
 import requests
-import fgrequests
 from telegram.ext.dispatcher import run_async
 
-from utils import bot_messages, bot_utils, decorators
+from utils import bot_messages, bot_utils, decorators, satellite_frames, media_cache
 
 
 satellitesFunctionsLogger = logging.getLogger(__name__)
@@ -19,128 +18,84 @@ satellitesFunctionsLogger.setLevel(logging.DEBUG)
 # @decorators.ignore_users
 @decorators.log_command
 def cmd_vpr(update, context):
-    """Fetch and send latest VPR satellite image to the user."""
+    """Send latest VPR satellite image to the user, from the shared frame store."""
 
-    try:
-        # "Guess" image from INMET's API
-        APIBaseURL = "https://apisat.inmet.gov.br/"
-        regiao = "BR"
-
-        # Get current time
-        utcNow = arrow.utcnow()
-        dayNow = utcNow.format("YYYY-MM-DD")
-        minutesNow = utcNow.format("mm")
-
-        # Get round hours
-        floorMinutes = int(minutesNow) // 10 * 10
-        floorDate = utcNow.replace(minute=floorMinutes)
-
-        # Create headers for requests
-        headers = {
-            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.87 Safari/537.36"
-        }
-
-        # We do this because retrieving hours from the API takes several seconds, so it is faster to guess endpoints (only three are possible)
-        requestURLS = []
-        for i in range(1, 4):
-            tryDate = floorDate.shift(minutes=-i * 10)
-            requestURLS.append(
-                f"{APIBaseURL}GOES/{regiao}/VP/{dayNow}/{tryDate.format('HH:mm')}"
-            )
-
-        # Request all URLs, filter the most recent one that was successful
-        response = list(
-            filter(lambda x: x.status_code == 200, fgrequests.build(requestURLS))
-        )
-        # Get json from the response
-        vprData = response[0].json()
-
-        context.bot.send_chat_action(
-            chat_id=update.effective_message.chat_id,
-            action=telegram.ChatAction.UPLOAD_PHOTO,
+    vprFrames = satellite_frames.get_latest_frames(1)
+    if not vprFrames:
+        context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            reply_to_message_id=update.message.message_id,
+            text=bot_messages.unavailableImage,
         )
+        return None
 
-        # Load image from base64 to memory
-        vprImage = bot_utils.loadB64ImageToMemory(vprData["base64"])
+    context.bot.send_chat_action(
+        chat_id=update.effective_message.chat_id,
+        action=telegram.ChatAction.UPLOAD_PHOTO,
+    )
 
-        hourLastImage = arrow.get(vprData["hora"], "HH:mm").to("-03:00").format("HH:mm")
-        hourLastImageCaption = f" ({hourLastImage})."
+    vprFrame = vprFrames[0]
+    hourLastImage = arrow.get(vprFrame.hour, "HH:mm").to("-03:00").format("HH:mm")
+    hourLastImageCaption = f" ({hourLastImage})."
 
-        caption = bot_messages.lastAvailableImageCaption + hourLastImageCaption
+    caption = bot_messages.lastAvailableImageCaption + hourLastImageCaption
 
-        # Send image from memory
-        context.bot.send_photo(
+    # Send image by file_id if it was already uploaded, from memory otherwise
+    media_cache.mediaCache.send(
+        ("vpr", vprFrame.region, vprFrame.date, vprFrame.hour),
+        lambda photo: context.bot.send_photo(
             chat_id=update.effective_chat.id,
             reply_to_message_id=update.message.message_id,
-            photo=vprImage,
+            photo=photo,
             caption=caption,
             timeout=20000,
-        )
-    # If no request was successful
-    except IndexError:
-        try:
-            # Request all images from today
-            response = requests.get(
-                f"{APIBaseURL}GOES/{regiao}/VP/{dayNow}",
-                headers=headers,
-                allow_redirects=False,
-            )
-
-            if response.status_code == 200:
-                # Get only the latest image
-                data = response.json()[0]
-                satellitesFunctionsLogger.info(
-                    "Successful GET request to API VPR endpoint!"
-                )
-
-                context.bot.send_chat_action(
-                    chat_id=update.effective_message.chat_id,
-                    action=telegram.ChatAction.UPLOAD_PHOTO,
-                )
-
-                # Load image from base64 to memory
-                vprImage = bot_utils.loadB64ImageToMemory(data["base64"])
-
-                # Send image from memory
-                context.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    reply_to_message_id=update.message.message_id,
-                    photo=vprImage,
-                    caption=bot_messages.lastAvailableImageCaption,
-                    timeout=20000,
-                )
-        # If all else fails
-        except IndexError:
-            context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                reply_to_message_id=update.message.message_id,
-                text=bot_messages.unavailableImage,
-            )
+        ),
+        lambda: bot_utils.loadImageBytesToMemory(vprFrame.image),
+    )
 
 
 @decorators.send_upload_video_action
 def send_vpr_video(
     update,
     context,
-    vprVideoPath,
-    nImages,
+    vprFrames,
     waitMessage,
     nImagesMessage,
     gifTimeBoundariesDict,
 ):
-    """Send the .mp4 file to the user and delete it."""
+    """Send the animation of the frames to the user: by file_id if it was already uploaded, or else the prerendered .mp4 file, or else a new .mp4 file (deleted afterwards)."""
 
+    nImages = len(vprFrames)
     timeBoundaries = ""
     if gifTimeBoundariesDict:
         timeBoundaries = f" (de {gifTimeBoundariesDict['firstImage']} até {gifTimeBoundariesDict['lastImage']})"
 
     caption = f"Últimas {nImages} imagens" + timeBoundaries
-    context.bot.send_animation(
-        chat_id=update.effective_chat.id,
-        reply_to_message_id=update.message.message_id,
-        caption=caption,
-        animation=open(vprVideoPath, "rb"),
-        timeout=20000,
+
+    framesKeys = tuple((frame.region, frame.date, frame.hour) for frame in vprFrames)
+    renderedPaths = []
+
+    def load_video():
+        vprAnimation = bot_utils.vprAnimations.get(nImages)
+        if vprAnimation and [
+            (frame.region, frame.date, frame.hour) for frame in vprAnimation[1]
+        ] == list(framesKeys):
+            return open(vprAnimation[0], "rb")
+
+        vprVideoPath = bot_utils.create_gif_vpr_data(vprFrames, nImages)
+        renderedPaths.append(vprVideoPath)
+        return open(vprVideoPath, "rb")
+
+    media_cache.mediaCache.send(
+        ("vpr_gif",) + framesKeys,
+        lambda animation: context.bot.send_animation(
+            chat_id=update.effective_chat.id,
+            reply_to_message_id=update.message.message_id,
+            caption=caption,
+            animation=animation,
+            timeout=20000,
+        ),
+        load_video,
     )
 
     context.bot.delete_message(
@@ -150,8 +105,9 @@ def send_vpr_video(
         chat_id=nImagesMessage.chat.id, message_id=nImagesMessage.message_id
     )
 
-    os.remove(vprVideoPath)
-    satellitesFunctionsLogger.info(f"Deleted {vprVideoPath}.")
+    for vprVideoPath in renderedPaths:
+        os.remove(vprVideoPath)
+        satellitesFunctionsLogger.info(f"Deleted {vprVideoPath}.")
 
 
 @run_async
@@ -170,65 +126,28 @@ def cmd_vpr_gif(update, context):
             parse_mode="markdown",
         )
 
-        # Get images from INMET's API
-        APIBaseURL = "https://apisat.inmet.gov.br/"
-        regiao = "BR"
-
-        utcNow = arrow.utcnow()
-        dayNow = utcNow.format("YYYY-MM-DD")
-
-        # Create headers for requests
-        headers = {
-            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.87 Safari/537.36"
-        }
-        response = requests.get(
-            f"{APIBaseURL}/horas/GOES/{regiao}/VP/{dayNow}",
-            headers=headers,
-            allow_redirects=True,
-        )
-        if response.status_code == 200:
-            satellitesFunctionsLogger.info(
-                "Successful GET request to API VPR endpoint!"
-            )
-            data = response.json()
-
-            # Get images from today + images from yesterday (if needed)
-            nImagesForToday = len(data)
-            dataYesterday = None
-            nImagesForYesterday = None
-            if nImages > nImagesForToday:
-                nImagesForYesterday = nImages - nImagesForToday
-                responseYesterday = requests.get(
-                    f"{APIBaseURL}/horas/GOES/{regiao}/VP/{utcNow.shift(days=-1).format('YYYY-MM-DD')}",
-                    headers=headers,
-                    allow_redirects=True,
-                )
-                dataYesterday = responseYesterday.json()[:nImagesForYesterday]
-
-            vprResponse = bot_utils.get_vpr_images_data(
-                data, nImages, dayNow, nImagesForYesterday, dataYesterday
-            )
+        # Get images from the shared frame store (apisat is only hit for frames it doesn't have yet)
+        vprFrames = bot_utils.get_vpr_images_data(nImages)
+        if vprFrames:
             gifTimeBoundariesDict = {
-                "firstImage": arrow.get(vprResponse[-1]["hora"], "HH:mm")
+                "firstImage": arrow.get(vprFrames[-1].hour, "HH:mm")
                 .to("-03:00")
                 .format("HH:mm"),
-                "lastImage": arrow.get(vprResponse[0]["hora"], "HH:mm")
+                "lastImage": arrow.get(vprFrames[0].hour, "HH:mm")
                 .to("-03:00")
                 .format("HH:mm"),
             }
-            gifFilename = bot_utils.create_gif_vpr_data(vprResponse, nImages)
 
             return send_vpr_video(
                 update,
                 context,
-                gifFilename,
-                nImages,
+                vprFrames,
                 waitMessage,
                 nImagesMessage,
                 gifTimeBoundariesDict,
             )
         else:
-            satellitesFunctionsLogger.error("Failed GET request to VPR API.")
+            satellitesFunctionsLogger.error("Failed to get VPR frames.")
             context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 reply_to_message_id=update.message.message_id,
@@ -274,66 +193,50 @@ def cmd_acumulada(update, context):
             action=telegram.ChatAction.UPLOAD_PHOTO,
         )
 
-        # Request image from INMET's API
+        # Adjust input to available intervals
+        availableIntervals = [1, 3, 5, 10, 15, 30, 90]
+        caption = ""
+        interval = inputInterval
+        if interval in availableIntervals:
+            caption = f"Precipitação acumulada nos últimos {interval} dias"
+            # indexInterval = availableIntervals.index(interval)
+        else:
+            # Get closest value to input if it isn't in the interval
+            absoluteDiff = lambda listValue: abs(listValue - interval)
+            interval = min(availableIntervals, key=absoluteDiff)
+
+            # Warn user about input change
+            acumuladaWarnMessage = context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                reply_to_message_id=update.message.message_id,
+                text=bot_messages.acumuladaWarn.format(
+                    interval=interval, inputInterval=inputInterval
+                ),
+                parse_mode="markdown",
+            )
+        if interval == 1:
+            caption = "Precipitação acumulada nas últimas 24 horas"
+
         brazilNow = arrow.utcnow().to("Brazil/East").shift(days=-1)
         dayNow = brazilNow.format("YYYY-MM-DD")
-        APIBaseURL = "https://apiprec.inmet.gov.br/"
-
-        # Create headers for requests
-        headers = {
-            "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.87 Safari/537.36"
-        }
-        response = requests.get(
-            f"{APIBaseURL}{dayNow}", headers=headers, allow_redirects=False
-        )
-        if response.status_code == 200:
-            satellitesFunctionsLogger.info(
-                "Successful GET request to INMET's APIPREC endpoint!"
-            )
 
-            # Get data from response
-            data = response.json()
-
-            # Adjust input to available intervals
-            availableIntervals = [1, 3, 5, 10, 15, 30, 90]
-            caption = ""
-            interval = inputInterval
-            if interval in availableIntervals:
-                caption = f"Precipitação acumulada nos últimos {interval} dias"
-                # indexInterval = availableIntervals.index(interval)
-            else:
-                # Get closest value to input if it isn't in the interval
-                absoluteDiff = lambda listValue: abs(listValue - interval)
-                interval = min(availableIntervals, key=absoluteDiff)
-
-                # Warn user about input change
-                acumuladaWarnMessage = context.bot.send_message(
+        try:
+            # Send image by file_id if it was already uploaded; otherwise, request it from INMET's API
+            media_cache.mediaCache.send(
+                ("acumulada", dayNow, interval),
+                lambda photo: context.bot.send_photo(
                     chat_id=update.effective_chat.id,
                     reply_to_message_id=update.message.message_id,
-                    text=bot_messages.acumuladaWarn.format(
-                        interval=interval, inputInterval=inputInterval
-                    ),
-                    parse_mode="markdown",
-                )
-            if interval == 1:
-                caption = "Precipitação acumulada nas últimas 24 horas"
-
-            # Get correct image dictionary from list inside json
-            data = data[availableIntervals.index(interval)]
-
-            # Load image from base64 string to memory
-            acumuladaImage = bot_utils.loadB64ImageToMemory(data["base64"])
-
-            # Send image from memory
-            context.bot.send_photo(
-                chat_id=update.effective_chat.id,
-                reply_to_message_id=update.message.message_id,
-                photo=acumuladaImage,
-                caption=caption,
-                timeout=20000,
+                    photo=photo,
+                    caption=caption,
+                    timeout=20000,
+                ),
+                lambda: get_acumulada_image(
+                    dayNow, availableIntervals.index(interval)
+                ),
             )
         # If request has failed
-        else:
+        except requests.exceptions.HTTPError:
             satellitesFunctionsLogger.error(
                 "Failed GET request to INMET's APIPREC endpoint."
             )
@@ -358,3 +261,23 @@ def cmd_acumulada(update, context):
             chat_id=acumuladaWarnMessage.chat.id,
             message_id=acumuladaWarnMessage.message_id,
         )
+
+
+def get_acumulada_image(day, intervalIndex):
+    """Request accumulated precipitation image of the interval at `intervalIndex` up to `day` from INMET's API and load it to memory."""
+
+    APIBaseURL = "https://apiprec.inmet.gov.br/"
+
+    # Create headers for requests
+    headers = {
+        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.87 Safari/537.36"
+    }
+    response = requests.get(f"{APIBaseURL}{day}", headers=headers, allow_redirects=False)
+    response.raise_for_status()
+    satellitesFunctionsLogger.info("Successful GET request to INMET's APIPREC endpoint!")
+
+    # Get correct image dictionary from list inside json
+    data = response.json()[intervalIndex]
+
+    # Load image from base64 string to memory
+    return bot_utils.loadB64ImageToMemory(data["base64"])
@@ -1,18 +1,30 @@
 import os
 import logging
-import time
-import schedule
 from threading import Thread
 
 from bot_config import updater
+from models import CityChats
 import bot_handlers  # noqa (ignore linter warning)
 from bot_routines import (
     parse_alerts_routine,
     delete_past_alerts_routine,
     notify_chats_routine,
+    notify_new_alerts_routine,
+    send_notifications_routine,
+    notifyLock,
+    sendLock,
 )
+from utils.scheduler import Scheduler
+from utils.bot_utils import prefetch_vpr_routine
 
-ROUTINES_INTERVAL = 15
+# Intervals (in seconds) between routine runs. INMET's feed is polled every ALERTS_MIN_INTERVAL while it is changing, backing off up to ALERTS_MAX_INTERVAL while it isn't
+ROUTINES_INTERVAL = 15 * 60
+ALERTS_MIN_INTERVAL = 2 * 60
+ALERTS_MAX_INTERVAL = 15 * 60
+OUTBOX_INTERVAL = 60
+# Satellite frames are published every 10 minutes
+FRAMES_MIN_INTERVAL = 2 * 60
+FRAMES_MAX_INTERVAL = 10 * 60
 
 # Enable logging
 logging.basicConfig(
@@ -22,31 +34,63 @@ logging.basicConfig(
     level=logging.DEBUG,
 )
 
-# Initialize bot routines
-try:
-    schedule.every(ROUTINES_INTERVAL).minutes.do(delete_past_alerts_routine)
-    schedule.every(ROUTINES_INTERVAL).minutes.do(parse_alerts_routine)
-    schedule.every(ROUTINES_INTERVAL).minutes.do(notify_chats_routine)
-except Exception as error:
-    logging.exception(f"Error in main routine: {error}")
-    pass
+# Initialize bot routines, each run in its own thread
+scheduler = Scheduler()
+scheduler.every(
+    "delete_past_alerts_routine", delete_past_alerts_routine, ROUTINES_INTERVAL
+)
+scheduler.every(
+    "parse_alerts_routine",
+    parse_alerts_routine,
+    ALERTS_MIN_INTERVAL,
+    maxInterval=ALERTS_MAX_INTERVAL,
+)
+# Backstop for alerts that weren't fanned out right after being inserted (e.g. after a restart)
+scheduler.every(
+    "notify_chats_routine", notify_chats_routine, ROUTINES_INTERVAL, lock=notifyLock
+)
+# Retry notifications that couldn't be sent
+scheduler.every(
+    "send_notifications_routine",
+    send_notifications_routine,
+    OUTBOX_INTERVAL,
+    deadline=ROUTINES_INTERVAL,
+    lock=sendLock,
+)
+# Download new satellite frames once, ahead of /vpr and /nuvens, and render the common animations
+scheduler.every(
+    "prefetch_vpr_routine",
+    prefetch_vpr_routine,
+    FRAMES_MIN_INTERVAL,
+    maxInterval=FRAMES_MAX_INTERVAL,
+)
+# Report how long routines take and how late they start
+scheduler.every("log_scheduler_stats", scheduler.log_stats, ROUTINES_INTERVAL)
 
 
-# Thread for running routines periodically
-class RoutinesThread(Thread):
+# Thread for notifying chats as soon as new alerts are inserted
+class NotifierThread(Thread):
     def run(self):
         while True:
-            schedule.run_pending()
-            time.sleep(60)
+            try:
+                notify_new_alerts_routine()
+            except Exception as error:
+                logging.exception(f"Error in notifier routine: {error}")
 
 
 def main():
+    # Subscriptions made before CityChats existed must be indexed by city to be notified
+    CityChats.ensure_city_chats()
+
     updater.start_polling()
 
-    # Start routines thread
-    fRoutines = RoutinesThread()
-    fRoutines.daemon = True
-    fRoutines.start()
+    # Start routines threads
+    scheduler.start()
+
+    # Start notifier thread
+    fNotifier = NotifierThread()
+    fNotifier.daemon = True
+    fNotifier.start()
 
     # Run the bot until Ctrl-C is pressed
     updater.idle()
@@ -0,0 +1,121 @@
+# Maintenance commands for the bot's database. Run `python manage.py --help` for usage.
+
+import argparse
+import logging
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from models import db, CityChats, Chat  # noqa (needs the environment variables loaded above)
+from utils import cep_ranges
+
+logging.basicConfig(format="%(asctime)s %(message)s", level=logging.INFO)
+
+
+def cmd_explain(args):
+    """Print explain-plan stats for every query issued by the bot."""
+
+    for description, collectionName, query, sort in db.QUERIES:
+        stats = db.INMETBotDB.explain_query(collectionName, query, sort)
+        scanWarning = " (collection scan!)" if "COLLSCAN" in stats["stages"] else ""
+        if "SORT" in stats["stages"]:
+            scanWarning += " (in-memory sort!)"
+        print(f"{description}{scanWarning}")
+        sortCall = f".sort({sort})" if sort else ""
+        print(f"    {collectionName}.find({query}){sortCall}")
+        print(
+            f"    plan: {' <- '.join(stats['stages'])}, "
+            f"returned: {stats['nReturned']}, "
+            f"keys examined: {stats['totalKeysExamined']}, "
+            f"docs examined: {stats['totalDocsExamined']}, "
+            f"time: {stats['executionTimeMillis']} ms"
+        )
+
+
+def cmd_migrate_dates(args):
+    """Convert alerts' dates stored as strings to dates."""
+
+    nMigrated = db.INMETBotDB.migrate_alert_dates()
+    print(f"Migrated dates of {nMigrated} alerts.")
+
+
+def cmd_rebuild_city_chats(args):
+    """Rebuild the CityChats collection from the subscribed chats' CEPs."""
+
+    nCityChats = CityChats.rebuild_city_chats()
+    print(f"Rebuilt CityChats with {nCityChats} (city, chat) pairs.")
+
+
+def cmd_backfill_locations(args):
+    """Store the city and IBGE code of CEPs subscribed before they were stored."""
+
+    nBackfilled = Chat.backfill_chats_locations()
+    print(f"Backfilled locations of {nBackfilled} CEPs.")
+
+
+def cmd_load_cep_ranges(args):
+    """Validate a CSV file of CEP ranges and store it as the bot's offline CEP table."""
+
+    nRanges = cep_ranges.load_cep_ranges(args.path)
+    print(f"Stored {nRanges} CEP ranges in {cep_ranges.CEP_RANGES_PATH}.")
+
+
+def cmd_bench_cep_ranges(args):
+    """Measure the offline CEP table's lookup latency."""
+
+    stats = cep_ranges.benchmark(args.lookups)
+    print(
+        f"{stats['nLookups']} lookups in {stats['nRanges']} CEP ranges "
+        f"({stats['nHits']} hits): {stats['meanMicroseconds']:.2f} µs per lookup"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="INMETBot maintenance commands.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    explainParser = subparsers.add_parser(
+        "explain", help="print explain-plan stats for every query issued by the bot"
+    )
+    explainParser.set_defaults(func=cmd_explain)
+
+    migrateDatesParser = subparsers.add_parser(
+        "migrate-dates", help="convert alerts' dates stored as strings to dates"
+    )
+    migrateDatesParser.set_defaults(func=cmd_migrate_dates)
+
+    rebuildCityChatsParser = subparsers.add_parser(
+        "rebuild-city-chats",
+        help="rebuild the index of which chats are subscribed to which cities",
+    )
+    rebuildCityChatsParser.set_defaults(func=cmd_rebuild_city_chats)
+
+    backfillLocationsParser = subparsers.add_parser(
+        "backfill-locations",
+        help="store the city and IBGE code of CEPs subscribed by older versions of the bot",
+    )
+    backfillLocationsParser.set_defaults(func=cmd_backfill_locations)
+
+    loadCEPRangesParser = subparsers.add_parser(
+        "load-cep-ranges",
+        help="store a CSV file of CEP ranges (cepStart,cepEnd,city,UF,IBGE) as the offline CEP table",
+    )
+    loadCEPRangesParser.add_argument("path", help="path to the CSV file")
+    loadCEPRangesParser.set_defaults(func=cmd_load_cep_ranges)
+
+    benchCEPRangesParser = subparsers.add_parser(
+        "bench-cep-ranges", help="measure the offline CEP table's lookup latency"
+    )
+    benchCEPRangesParser.add_argument(
+        "--lookups", type=int, default=100000, help="number of random CEPs to look up"
+    )
+    benchCEPRangesParser.set_defaults(func=cmd_bench_cep_ranges)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,21 @@
 import logging
 import arrow
 import re
+import pymongo
 
+from alerts.parse_cap import record_from_soup
 from . import db
 
 modelsLogger = logging.getLogger(__name__)
 modelsLogger.setLevel(logging.DEBUG)
 
+# Patterns used to process the raw fields of an alert's CAP document
+EVENT_PATTERN = re.compile(r"(.*?)(?= Severidade)")
+SEVERITY_PATTERN = re.compile(r"(?<=Severidade Grau: )(.*)")
+DESCRIPTION_PATTERN = re.compile(r"INMET publica aviso iniciando em: .*?\. (.*)")
+AREA_PATTERN = re.compile(r"(?<=Aviso para as áreas: )(.*)")
+CITY_SUFFIX_PATTERN = re.compile(r"\s\-.*?\)")
+
 
 class Alert:
     """The Alert object can carry information about an alert (reads from XML file or json).
@@ -15,13 +24,19 @@ class Alert:
     ----------
     alertXML : BeautifulSoup
         A BS4-parsed XML file.
+    capRecord : CAPRecord
+        The fields of a CAP document parsed by `alerts.parse_cap.parse_cap`.
     alertDict : dict
         A dictionary containing the Alert's information.
+    guid : str
+        The guid of the Alert's item in INMET's RSS feed (URL to the XML file).
 
     Attributes
     ----------
     id : str
         The Alert ID.
+    guid : str
+        The guid of the Alert's item in INMET's RSS feed.
     event : str
         The Alert event/header.
     severity : str
@@ -38,22 +53,20 @@ class Alert:
         List of cities warned by the Alert.
     """
 
-    def __init__(self, alertXML=None, alertDict=None):
-        if alertXML:
-            self.get_id_from_XML(alertXML)
-            self.get_event_from_XML(alertXML)
-            self.get_severity_from_XML(alertXML)
-            self.get_startDate_from_XML(alertXML)
-            self.get_endDate_from_XML(alertXML)
-            self.get_description_from_XML(alertXML)
-            self.get_area_from_XML(alertXML)
-            self.get_cities_from_XML(alertXML)
+    def __init__(self, alertXML=None, alertDict=None, guid=None, capRecord=None):
+        self.guid = guid
+        if capRecord:
+            self.set_from_CAP_record(capRecord)
+        elif alertXML:
+            self.set_from_CAP_record(record_from_soup(alertXML))
         elif alertDict:
             self.id = alertDict["alertID"]
+            self.guid = alertDict.get("guid")
             self.event = alertDict["event"]
             self.severity = alertDict["severity"]
-            self.startDate = arrow.get(alertDict["startDate"])
-            self.endDate = arrow.get(alertDict["endDate"])
+            # Dates are stored in UTC
+            self.startDate = arrow.get(alertDict["startDate"]).to("Brazil/East")
+            self.endDate = arrow.get(alertDict["endDate"]).to("Brazil/East")
             self.description = alertDict["description"]
             self.area = alertDict["area"]
             self.cities = alertDict["cities"]
@@ -78,11 +91,62 @@ class Alert:
         # queryAlert = INMETBotDB.alertsCollection.find_one({"alertID": self.id})
         # if not queryAlert:
         alertDocument = self.serialize()
-        alertDocument["notifiedChats"] = []
         db.INMETBotDB.alertsCollection.insert_one(alertDocument)
         modelsLogger.info(f"Inserted new alert: {self}")
         # modelsLogger.info("Alert already exists; not inserted.")
 
+    @classmethod
+    def upsert_alerts(cls, alerts):
+        """Insert alerts that aren't in the database yet with a single unordered bulk write.
+
+        Alerts are upserted by their ID (which has a unique index), so overlapping ingests can't insert the same alert twice.
+
+        Parameters
+        --------
+        alerts : list : Alert
+            Alerts to be inserted.
+
+        Returns
+        --------
+        (insertedIDs, presentIDs) : tuple
+            IDs of the alerts that were inserted and of the ones that were already present.
+        """
+
+        if not alerts:
+            return ([], [])
+
+        operations = []
+        for alert in alerts:
+            alertDocument = alert.serialize()
+            # Chats are notified about the alert by `notify_chats_routine`
+            alertDocument["fannedOut"] = False
+            operations.append(
+                pymongo.UpdateOne(
+                    {"alertID": alert.id}, {"$setOnInsert": alertDocument}, upsert=True
+                )
+            )
+
+        try:
+            result = db.INMETBotDB.alertsCollection.bulk_write(operations, ordered=False)
+            upsertedIndexes = set(result.upserted_ids.keys())
+        except pymongo.errors.BulkWriteError as bulkWriteError:
+            # Duplicate key errors mean a concurrent ingest has inserted the alert first
+            details = bulkWriteError.details
+            if any(error["code"] != 11000 for error in details["writeErrors"]):
+                raise
+            upsertedIndexes = {upserted["index"] for upserted in details["upserted"]}
+
+        insertedIDs = [alerts[index].id for index in sorted(upsertedIndexes)]
+        presentIDs = [
+            alert.id
+            for index, alert in enumerate(alerts)
+            if index not in upsertedIndexes
+        ]
+        modelsLogger.info(
+            f"Inserted {len(insertedIDs)} new alerts; {len(presentIDs)} were already present."
+        )
+        return (insertedIDs, presentIDs)
+
     def determine_severity_emoji(self):
         """Determine emoji for alert message and return it."""
 
@@ -129,81 +193,82 @@ class Alert:
 
         alertDocument = {
             "alertID": self.id,
+            "guid": self.guid,
             "event": self.event,
             "severity": self.severity,
-            "startDate": self.startDate.for_json(),
-            "endDate": self.endDate.for_json(),
+            "startDate": self.startDate.datetime,
+            "endDate": self.endDate.datetime,
             "description": self.description,
             "area": self.area,
             "cities": self.cities,
         }
         return alertDocument
 
-    def set_id_from_XML(self, alertXML):
-        """Extract id string from XML."""
-
-        alertID = alertXML.identifier.text.replace("urn:oid:", "")
-        self.id = alertID
-
-    def set_event_from_XML(self, alertXML):
-        """Extract event string from XML."""
-
-        eventPattern = r"(.*?)(?= Severidade)"
-        rawEvent = alertXML.info.headline.text
-        eventMatch = re.search(eventPattern, rawEvent)
-        if eventMatch:
-            self.event = eventMatch.group(1)
+    def set_from_CAP_record(self, capRecord):
+        """Set attributes from a CAPRecord, processing its raw fields."""
 
-    def set_severity_from_XML(self, alertXML):
-        """Extract severity string from XML."""
+        self.id = capRecord.identifier.replace("urn:oid:", "")
 
-        rawSeverity = alertXML.info.headline.text
-        severityPattern = r"(?<=Severidade Grau: )(.*)"
-        severityMatch = re.search(severityPattern, rawSeverity)
-        if severityMatch:
-            self.severity = severityMatch.group(1)
+        eventMatch = EVENT_PATTERN.search(capRecord.headline)
+        self.event = eventMatch.group(1) if eventMatch else None
 
-    def set_description_from_XML(self, alertXML):
-        """Extract description string from XML."""
+        severityMatch = SEVERITY_PATTERN.search(capRecord.headline)
+        self.severity = severityMatch.group(1) if severityMatch else None
 
-        rawDescription = alertXML.info.description.text
-        descriptionPattern = r"INMET publica aviso iniciando em: .*?\. (.*)"
-        descriptionMatch = re.search(descriptionPattern, rawDescription)
-        if descriptionMatch:
-            self.description = descriptionMatch.group(1)
+        self.startDate = arrow.get(capRecord.onset)
+        self.endDate = arrow.get(capRecord.expires)
 
-    def set_area_from_XML(self, alertXML):
-        """Extract area string from XML, process it and put it in a list."""
+        descriptionMatch = DESCRIPTION_PATTERN.search(capRecord.description)
+        self.description = descriptionMatch.group(1) if descriptionMatch else None
 
-        rawArea = alertXML.info.area.areaDesc.text
-        areaPattern = r"(?<=Aviso para as áreas: )(.*)"
-        areaMatch = re.search(areaPattern, rawArea)
-        if areaMatch:
-            self.area = [region for region in areaMatch.group(1).split(",")]
+        areaMatch = AREA_PATTERN.search(capRecord.areaDesc)
+        self.area = areaMatch.group(1).split(",") if areaMatch else None
 
-    def set_cities_from_XML(self, alertXML):
-        """Extract cities string from XML, process it and put it in a list."""
+        rawCities = capRecord.municipalities.split(",")
+        self.cities = [CITY_SUFFIX_PATTERN.sub("", city).strip() for city in rawCities]
 
-        parameters = alertXML.info.find_all("parameter")
-        citiesParameter = None
-        for parameter in parameters:
-            if "Municipio" in parameter.valueName.text:
-                citiesParameter = parameter
-        rawCities = citiesParameter.value.text.split(",")
-        cities = [re.sub(r"\s\-.*?\)", "", city).strip() for city in rawCities]
-        self.cities = cities
 
-    def set_startDate_from_XML(self, alertXML):
-        """Extract startDate string from XML (convert to arrow Object)."""
+class AlertRenderer:
+    """The AlertRenderer object renders alert messages, building each Alert object once and memoizing each message, so rendering the same alert for many chats costs a dictionary lookup.
 
-        startDate = arrow.get(str(alertXML.info.onset.text))
-        self.startDate = startDate
+    Alerts don't change once stored, so a renderer can be kept for a whole notification cycle.
 
-    def set_endDate_from_XML(self, alertXML):
-        """Extract endDate string from XML (convert to arrow Object)."""
+    Attributes
+    ----------
+    alerts : dict
+        Alert objects keyed by alert ID.
+    messages : dict
+        Rendered messages keyed by (alertID, location, brazil), location being a tuple of cities (or a single city, or None).
+    stats : dict
+        Number of messages rendered (misses) and reused (hits).
+    """
 
-        endDate = arrow.get(str(alertXML.info.expires.text))
-        self.endDate = endDate
+    def __init__(self):
+        self.alerts = {}
+        self.messages = {}
+        self.stats = {"hits": 0, "misses": 0}
+
+    def get_alert(self, alertDict):
+        """Get the Alert object of an alert document, building it on first use."""
+
+        alertID = alertDict["alertID"]
+        if alertID not in self.alerts:
+            self.alerts[alertID] = Alert(alertDict=alertDict)
+        return self.alerts[alertID]
+
+    def get_alert_message(self, alertDict, location=None, brazil=False):
+        """Get the message of an alert document, as `Alert.get_alert_message` would render it."""
+
+        locationKey = tuple(location) if isinstance(location, list) else location
+        messageKey = (alertDict["alertID"], locationKey, brazil)
+        message = self.messages.get(messageKey)
+        if message is None:
+            self.stats["misses"] += 1
+            message = self.get_alert(alertDict).get_alert_message(location, brazil)
+            self.messages[messageKey] = message
+        else:
+            self.stats["hits"] += 1
+        return message
 
 
 if __name__ == "__main__":
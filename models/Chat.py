@@ -1,8 +1,13 @@
 import logging
 from abc import ABC, abstractmethod
+
+import arrow
+
 from utils import viacep
 
 from . import db
+from . import CityChats
+from . import Outbox
 
 modelsLogger = logging.getLogger(__name__)
 modelsLogger.setLevel(logging.DEBUG)
@@ -25,6 +30,8 @@ class Chat(ABC):
         The title of the chat (group's title or user's username).
     CEPs : list : str
         List of subscribed CEPs. This should be a relation with a different entity in a relational database.
+    locations : list : dict
+        City and IBGE code of each subscribed CEP ({"CEP", "city", "IBGE"}), resolved when the CEP was subscribed.
     subscribed : bool
         Whether the chat is subscribed to alerts or not.
     activated : bool
@@ -57,12 +64,22 @@ class Chat(ABC):
         if queryChat:
             self.subscribed = True
             self.CEPs = queryChat["CEPs"]
+            self.locations = queryChat.get("locations", [])
             self.activated = queryChat.get("activated", True)
         else:
             self.subscribed = False
             self.CEPs = []
+            self.locations = []
             self.activated = True
 
+    def get_CEP_location(self, cep):
+        """Get the stored location of a subscribed CEP, looking it up if it hasn't been stored."""
+
+        for location in self.locations:
+            if location["CEP"] == cep:
+                return location
+        return viacep.get_cep_location(cep)
+
     def get_chat_CEPs(self):
         """Get chat's subscribed CEPs."""
 
@@ -98,10 +115,12 @@ class Chat(ABC):
                     return "CHAT_EXISTS_CEP_EXISTS"
 
                 # Check if the city for this CEP is already subscribed (the alerts' granularity is only to the city level)
-                # REVIEW: Maybe save cities instead to simplify comparison?
-                # self.CEPs shouldn't be too long (1-10 entries), so this cost is negligible
-                cityCep = viacep.get_cep_city(cep)
-                citiesCEPs = [viacep.get_cep_city(cep) for cep in self.CEPs]
+                location = viacep.get_cep_location(cep)
+                cityCep = location["city"]
+                citiesCEPs = [
+                    self.get_CEP_location(subscribedCep)["city"]
+                    for subscribedCep in self.CEPs
+                ]
 
                 # City 'is' already subscribed; don't subscribe this CEP
                 if cityCep in citiesCEPs:
@@ -111,17 +130,23 @@ class Chat(ABC):
                     return "CHAT_EXISTS_CITY_EXISTS"
                 else:  # Chat is already subscribed, new CEP
                     db.INMETBotDB.subscribedChatsCollection.update_one(
-                        {"chatID": self.id}, {"$push": {"CEPs": cep}}
+                        {"chatID": self.id},
+                        {"$push": {"CEPs": cep, "locations": location}},
                     )
+                    CityChats.add_chat_city(self.id, cityCep)
+                    self.enqueue_active_alerts([cityCep])
                     modelsLogger.info(f"CEP {cep} has been subscribed.")
                     return "CHAT_EXISTS_CEP_SUBSCRIBED"
             else:  # Chat is already subscribed, no CEP
                 return "CHAT_EXISTS_NO_CEP"
                 modelsLogger.info(f"Chat {self.id} is already subscribed.")
         else:  # Chat is not subscribed, CEP is optional
-            chatDocument = self.serialize(cep)
+            location = viacep.get_cep_location(cep) if cep else None
+            chatDocument = self.serialize(location)
             db.INMETBotDB.subscribedChatsCollection.insert_one(chatDocument)
             if cep:
+                CityChats.add_chat_city(self.id, location["city"])
+                self.enqueue_active_alerts([location["city"]])
                 modelsLogger.info(f"Chat {self.id} and CEP {cep} have been subscribed.")
                 return "CHAT_AND_CEP_SUBSCRIBED"
             else:
@@ -138,11 +163,14 @@ class Chat(ABC):
         if self.subscribed:
             if cep:
                 if cep in self.CEPs:  # Chat is subscribed, CEP is subscribed
+                    location = self.get_CEP_location(cep)
                     db.INMETBotDB.subscribedChatsCollection.update_one(
-                        {"chatID": self.id}, {"$pull": {"CEPs": cep}}
+                        {"chatID": self.id},
+                        {"$pull": {"CEPs": cep, "locations": {"CEP": cep}}},
                     )
+                    CityChats.remove_chat_city(self.id, location["city"])
                     unsubscribeMessage = (
-                        f"🔕 Desinscrevi o CEP {cep} (*{viacep.get_cep_city(cep)}*)."
+                        f"🔕 Desinscrevi o CEP {cep} (*{location['city']}*)."
                     )
                     modelsLogger.info(f"CEP {cep} has been unsubscribed.")
                     return "CHAT_EXISTS_CEP_UNSUBSCRIBED"
@@ -151,6 +179,7 @@ class Chat(ABC):
                     return "CHAT_EXISTS_CEP_NOT_FOUND"
             else:  # Chat is subscribed, no CEP
                 db.INMETBotDB.subscribedChatsCollection.delete_one({"chatID": self.id})
+                CityChats.remove_chat(self.id)
                 modelsLogger.info(f"Chat {self.id} has been unsubscribed.")
                 return "CHAT_UNSUBSCRIBED"
         else:  # Chat is not subscribed, CEP is optional
@@ -158,6 +187,35 @@ class Chat(ABC):
             return "CHAT_NOT_UNSUBSCRIBED"
         return unsubscribeMessage
 
+    def enqueue_active_alerts(self, cities=None):
+        """Enqueue notifications about the alerts in force for the chat's cities, which were fanned out before the chat subscribed to (or reactivated) them.
+
+        Alerts the chat has already been notified about are left out.
+
+        Parameters
+        ----------
+        cities : list : str
+            Cities to be checked. Defaults to the cities of every subscribed CEP.
+        """
+
+        if cities is None:
+            cities = [self.get_CEP_location(cep)["city"] for cep in self.CEPs]
+        if not cities:
+            return
+
+        activeAlerts = list(
+            db.INMETBotDB.alertsCollection.find(
+                {
+                    "cities": {"$in": cities},
+                    "endDate": {"$gt": arrow.utcnow().datetime},
+                }
+            )
+        )
+        nEnqueued = Outbox.enqueue_alerts(activeAlerts, {self.id: set(cities)})
+        modelsLogger.info(
+            f"Enqueued {nEnqueued} notifications of active alerts to chat {self.id}."
+        )
+
     def check_subscription_status(self):
         """Check chat's subscription status.
         Returns
@@ -170,7 +228,7 @@ class Chat(ABC):
             if self.CEPs:
                 cepMessage = "CEPs inscritos:\n"
                 for cep in self.CEPs:
-                    cepMessage += f"{cep} (*{viacep.get_cep_city(cep)}*)\n"
+                    cepMessage += f"{cep} (*{self.get_CEP_location(cep)['city']}*)\n"
             else:
                 cepMessage = "Não há CEPs inscritos."
 
@@ -205,6 +263,7 @@ class Chat(ABC):
             db.INMETBotDB.subscribedChatsCollection.update_one(
                 {"chatID": self.id}, {"$set": {"activated": True}}
             )
+            self.enqueue_active_alerts()
             return "▶️ Ativei os alertas.\nDesative-os temporariamente com /desativar."
         else:
             return "❕ Os alertas já estão ativados.\nDesative-os temporariamente com */desativar*."
@@ -221,16 +280,24 @@ class Chat(ABC):
             db.INMETBotDB.subscribedChatsCollection.update_one(
                 {"chatID": self.id}, {"$set": {"activated": True}}
             )
+            self.enqueue_active_alerts()
             return "▶️ Ativei os alertas novamente.\nDesative-os com /desativar."
 
-    def serialize(self, cep=None):
-        """Serialize chat subscription for database insertion."""
+    def serialize(self, location=None):
+        """Serialize chat subscription for database insertion.
 
-        if cep:
+        Parameters
+        ----------
+        location : dict
+            Location of the subscribed CEP, as returned by `viacep.get_cep_location`.
+        """
+
+        if location:
             subscribedChatsDocument = {
                 "chatID": self.id,
                 "title": self.title,
-                "CEPs": [cep],
+                "CEPs": [location["CEP"]],
+                "locations": [location],
                 "activated": True,
             }
         else:
@@ -238,11 +305,43 @@ class Chat(ABC):
                 "chatID": self.id,
                 "title": self.title,
                 "CEPs": [],
+                "locations": [],
                 "activated": True,
             }
         return subscribedChatsDocument
 
 
+def backfill_chats_locations():
+    """Store the location of every subscribed CEP that was subscribed before locations were stored.
+
+    Returns
+    --------
+    nBackfilled : int
+        Number of backfilled CEPs.
+    """
+
+    nBackfilled = 0
+    for chat in db.INMETBotDB.subscribedChatsCollection.find({}):
+        storedCEPs = {location["CEP"] for location in chat.get("locations", [])}
+        missingLocations = []
+        for cep in chat["CEPs"]:
+            if cep not in storedCEPs:
+                try:
+                    missingLocations.append(viacep.get_cep_location(cep))
+                except Exception as error:
+                    modelsLogger.warning(f"Viacep error for CEP {cep}: {error}")
+
+        if missingLocations:
+            db.INMETBotDB.subscribedChatsCollection.update_one(
+                {"chatID": chat["chatID"]},
+                {"$push": {"locations": {"$each": missingLocations}}},
+            )
+            nBackfilled += len(missingLocations)
+
+    modelsLogger.info(f"Backfilled locations of {nBackfilled} CEPs.")
+    return nBackfilled
+
+
 class PrivateChat(Chat):
     """The PrivateChat object can carry information about a private chat.
     Parameters
@@ -0,0 +1,102 @@
+import logging
+from collections import defaultdict
+
+import pymongo
+
+from utils import viacep
+from . import db
+
+modelsLogger = logging.getLogger(__name__)
+modelsLogger.setLevel(logging.DEBUG)
+
+# The CityChats collection maps cities to the chats subscribed to them (through CEPs).
+# Each document is {"city", "chatID"}, unique by (city, chatID). It is maintained by
+# `Chat.subscribe_chat`/`Chat.unsubscribe_chat`, so alerts can be fanned out by city.
+
+
+def add_chat_city(chatID, city):
+    """Subscribe chat to city."""
+
+    db.INMETBotDB.cityChatsCollection.update_one(
+        {"city": city, "chatID": chatID},
+        {"$setOnInsert": {"city": city, "chatID": chatID}},
+        upsert=True,
+    )
+
+
+def remove_chat_city(chatID, city):
+    """Unsubscribe chat from city."""
+
+    db.INMETBotDB.cityChatsCollection.delete_one({"city": city, "chatID": chatID})
+
+
+def remove_chat(chatID):
+    """Unsubscribe chat from all of its cities."""
+
+    db.INMETBotDB.cityChatsCollection.delete_many({"chatID": chatID})
+
+
+def get_chats_cities(cities):
+    """Get the chats subscribed to any of `cities`.
+
+    Returns
+    --------
+    chatsCities : dict
+        Set of subscribed cities (among `cities`) keyed by chat ID.
+    """
+
+    chatsCities = defaultdict(set)
+    for cityChat in db.INMETBotDB.cityChatsCollection.find(
+        {"city": {"$in": list(cities)}}, {"city": 1, "chatID": 1, "_id": 0}
+    ):
+        chatsCities[cityChat["chatID"]].add(cityChat["city"])
+    return dict(chatsCities)
+
+
+def rebuild_city_chats():
+    """Rebuild the CityChats collection from the subscribed chats' CEPs.
+
+    Cities are taken from the locations stored along with the CEPs, falling back to viacep for CEPs without one.
+
+    Returns
+    --------
+    nCityChats : int
+        Number of (city, chat) pairs in the rebuilt collection.
+    """
+
+    operations = []
+    subscribedChats = db.INMETBotDB.subscribedChatsCollection.find(
+        {}, {"chatID": 1, "CEPs": 1, "locations": 1}
+    )
+    for chat in subscribedChats:
+        storedCities = {
+            location["CEP"]: location["city"] for location in chat.get("locations", [])
+        }
+        for cep in chat["CEPs"]:
+            try:
+                city = storedCities.get(cep) or viacep.get_cep_city(cep)
+            except Exception as error:
+                modelsLogger.warning(f"Viacep error for CEP {cep}: {error}")
+                continue
+            operations.append(
+                pymongo.UpdateOne(
+                    {"city": city, "chatID": chat["chatID"]},
+                    {"$setOnInsert": {"city": city, "chatID": chat["chatID"]}},
+                    upsert=True,
+                )
+            )
+
+    if operations:
+        db.INMETBotDB.cityChatsCollection.bulk_write(operations, ordered=False)
+    modelsLogger.info(f"Rebuilt CityChats with {len(operations)} (city, chat) pairs.")
+    return len(operations)
+
+
+def ensure_city_chats():
+    """Build the CityChats collection if it is empty but there are subscribed chats (e.g. right after upgrading)."""
+
+    if db.INMETBotDB.cityChatsCollection.find_one() is None:
+        if db.INMETBotDB.subscribedChatsCollection.find_one(
+            {"CEPs.0": {"$exists": True}}
+        ):
+            rebuild_city_chats()
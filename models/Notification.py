@@ -0,0 +1,79 @@
+import logging
+import arrow
+import pymongo
+
+from . import db
+
+modelsLogger = logging.getLogger(__name__)
+modelsLogger.setLevel(logging.DEBUG)
+
+# The Notifications collection is a ledger of which chats have been notified about which alerts.
+# Each document is {"alertID", "chatID", "notifiedAt", "expiresAt"}, unique by (alertID, chatID),
+# and expires along with its alert.
+
+
+def get_notified_pairs(alertIDs, chatIDs):
+    """Get which of the alerts in `alertIDs` have already been notified to which of the chats in `chatIDs`, with a single query.
+
+    Returns
+    --------
+    notifiedPairs : set : tuple
+        (alertID, chatID) of each notification already recorded.
+    """
+
+    if not alertIDs or not chatIDs:
+        return set()
+
+    return {
+        (notification["alertID"], notification["chatID"])
+        for notification in db.INMETBotDB.notificationsCollection.find(
+            {"alertID": {"$in": list(alertIDs)}, "chatID": {"$in": list(chatIDs)}},
+            {"alertID": 1, "chatID": 1, "_id": 0},
+        )
+    }
+
+
+def mark_notified(notifications):
+    """Record notifications in the ledger with a single unordered bulk insert.
+
+    Notifications that were already recorded are ignored.
+
+    Parameters
+    --------
+    notifications : list : tuple
+        (alertID, chatID, endDate) of each notification, endDate being the alert's endDate.
+
+    Returns
+    --------
+    nInserted : int
+        Number of notifications recorded.
+    """
+
+    if not notifications:
+        return 0
+
+    timeNow = arrow.utcnow().datetime
+    notificationDocuments = [
+        {
+            "alertID": alertID,
+            "chatID": chatID,
+            "notifiedAt": timeNow,
+            "expiresAt": arrow.get(endDate).datetime,
+        }
+        for alertID, chatID, endDate in notifications
+    ]
+
+    try:
+        result = db.INMETBotDB.notificationsCollection.insert_many(
+            notificationDocuments, ordered=False
+        )
+        nInserted = len(result.inserted_ids)
+    except pymongo.errors.BulkWriteError as bulkWriteError:
+        # Duplicate key errors mean the notification was already recorded
+        details = bulkWriteError.details
+        if any(error["code"] != 11000 for error in details["writeErrors"]):
+            raise
+        nInserted = details["nInserted"]
+
+    modelsLogger.debug(f"Recorded {nInserted} notifications.")
+    return nInserted
@@ -0,0 +1,305 @@
+import hashlib
+import logging
+import datetime
+
+import arrow
+import pymongo
+
+from . import db
+from . import Notification
+from .Alert import AlertRenderer
+from utils import bot_messages, message_packer
+
+modelsLogger = logging.getLogger(__name__)
+modelsLogger.setLevel(logging.DEBUG)
+
+# The Outbox collection holds the notifications waiting to be sent. Each document is a job
+# {"_id", "chatID", "alerts": [{"alertID", "endDate"}], "messages", "nSent", "status",
+# "attempts", "availableAt", "createdAt", "expiresAt"}, whose _id is derived from the chat
+# and its alerts so enqueuing the same notification twice is a no-op.
+# A sender leases a job by pushing its availableAt forward, so jobs leased by a sender that
+# crashed are sent again once the lease expires.
+
+STATUS_PENDING = "pending"
+STATUS_SENT = "sent"
+STATUS_FAILED = "failed"
+
+# Time (in seconds) a leased job is hidden from other senders
+LEASE_DURATION = 5 * 60
+# Backoff (in seconds) before retrying a job after a transient error: BACKOFF_BASE * 2 ** (attempts - 1), up to BACKOFF_MAX
+BACKOFF_BASE = 60
+BACKOFF_MAX = 60 * 60
+# Jobs are given up on after this many attempts
+MAX_ATTEMPTS = 8
+# Time (in seconds) sent and failed jobs are kept for
+FINISHED_JOBS_TTL = 24 * 60 * 60
+
+
+def get_job_id(chatID, alertIDs):
+    """Get the deterministic _id of the job notifying the chat about the alerts."""
+
+    jobKey = f"{chatID}:{','.join(sorted(alertIDs))}"
+    return hashlib.sha1(jobKey.encode()).hexdigest()
+
+
+def enqueue(jobs):
+    """Enqueue notification jobs with a single unordered bulk upsert. Jobs already enqueued are left untouched.
+
+    Parameters
+    --------
+    jobs : list : tuple
+        (chatID, alerts, messages) of each job, where alerts is a list of {"alertID", "endDate"} and messages a list of rendered messages.
+
+    Returns
+    --------
+    nEnqueued : int
+        Number of jobs enqueued.
+    """
+
+    if not jobs:
+        return 0
+
+    timeNow = arrow.utcnow().datetime
+    operations = []
+    for chatID, alerts, messages in jobs:
+        jobID = get_job_id(chatID, [alert["alertID"] for alert in alerts])
+        operations.append(
+            pymongo.UpdateOne(
+                {"_id": jobID},
+                {
+                    "$setOnInsert": {
+                        "chatID": chatID,
+                        "alerts": [
+                            {"alertID": alert["alertID"], "endDate": alert["endDate"]}
+                            for alert in alerts
+                        ],
+                        "messages": messages,
+                        "nSent": 0,
+                        "status": STATUS_PENDING,
+                        "attempts": 0,
+                        "availableAt": timeNow,
+                        "createdAt": timeNow,
+                        # Pending jobs expire along with their last alert
+                        "expiresAt": max(
+                            arrow.get(alert["endDate"]).datetime for alert in alerts
+                        ),
+                    }
+                },
+                upsert=True,
+            )
+        )
+
+    result = db.INMETBotDB.outboxCollection.bulk_write(operations, ordered=False)
+    modelsLogger.debug(f"Enqueued {result.upserted_count}/{len(jobs)} jobs.")
+    return result.upserted_count
+
+
+def enqueue_alerts(alerts, chatsCities):
+    """Enqueue a job for each activated chat with the alerts (for its cities) it hasn't been notified about, nor is queued to be.
+
+    Parameters
+    --------
+    alerts : list : dict
+        Alert documents.
+    chatsCities : dict
+        Cities (set) affected by the alerts that each chat is subscribed to, keyed by chat ID.
+
+    Returns
+    --------
+    nEnqueued : int
+        Number of jobs enqueued.
+    """
+
+    if not alerts or not chatsCities:
+        return 0
+
+    alertIDs = [alert["alertID"] for alert in alerts]
+    notifiedPairs = Notification.get_notified_pairs(alertIDs, chatsCities.keys())
+    notifiedPairs |= get_queued_pairs(alertIDs, chatsCities.keys())
+
+    subscribedChats = db.INMETBotDB.subscribedChatsCollection.find(
+        {"chatID": {"$in": list(chatsCities)}, "activated": {"$ne": False}}
+    )
+    # Chats with the same affected cities get the same messages, rendered only once
+    alertRenderer = AlertRenderer()
+    jobs = []
+    for chat in subscribedChats:
+        chatCities = chatsCities[chat["chatID"]]
+        chatAlerts = [
+            alert
+            for alert in alerts
+            if chatCities.intersection(alert["cities"])
+            and (alert["alertID"], chat["chatID"]) not in notifiedPairs
+        ]
+        if not chatAlerts:
+            continue
+
+        modelsLogger.info(
+            f"-- Enqueuing notification of alerts {[alert['alertID'] for alert in chatAlerts]} to chat {chat['chatID']}... --"
+        )
+
+        alertsMessages = [
+            alertRenderer.get_alert_message(
+                alert, sorted(chatCities.intersection(alert["cities"]))
+            )
+            for alert in chatAlerts
+        ]
+
+        # "Footer" message after all alerts
+        messages = message_packer.pack_messages(
+            alertsMessages, bot_messages.moreInfoAlertAS
+        )
+
+        jobs.append((chat["chatID"], chatAlerts, messages))
+
+    modelsLogger.debug(f"Rendered alert messages: {alertRenderer.stats}")
+    return enqueue(jobs)
+
+
+def get_queued_pairs(alertIDs, chatIDs):
+    """Get which of the alerts in `alertIDs` are already queued to be notified to which of the chats in `chatIDs`.
+
+    Returns
+    --------
+    queuedPairs : set : tuple
+        (alertID, chatID) of each pending notification.
+    """
+
+    if not alertIDs or not chatIDs:
+        return set()
+
+    return {
+        (alert["alertID"], job["chatID"])
+        for job in db.INMETBotDB.outboxCollection.find(
+            {
+                "alerts.alertID": {"$in": list(alertIDs)},
+                "chatID": {"$in": list(chatIDs)},
+                "status": STATUS_PENDING,
+            },
+            {"alerts.alertID": 1, "chatID": 1, "_id": 0},
+        )
+        for alert in job["alerts"]
+    }
+
+
+def lease_jobs(limit):
+    """Lease up to `limit` pending jobs that are due, oldest first.
+
+    Returns
+    --------
+    jobs : list : dict
+        The leased jobs, with attempts already incremented.
+    """
+
+    jobs = []
+    for _ in range(limit):
+        timeNow = arrow.utcnow().datetime
+        job = db.INMETBotDB.outboxCollection.find_one_and_update(
+            {"status": STATUS_PENDING, "availableAt": {"$lte": timeNow}},
+            {
+                "$set": {
+                    "availableAt": timeNow
+                    + datetime.timedelta(seconds=LEASE_DURATION)
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("availableAt", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        if job is None:
+            break
+        jobs.append(job)
+    return jobs
+
+
+def complete_jobs(jobs):
+    """Mark jobs as sent with a single update.
+
+    Returns
+    --------
+    notifications : list : tuple
+        (alertID, chatID, endDate) of each notification sent, to be recorded in the ledger.
+    """
+
+    if not jobs:
+        return []
+
+    timeNow = arrow.utcnow().datetime
+    db.INMETBotDB.outboxCollection.update_many(
+        {"_id": {"$in": [job["_id"] for job in jobs]}},
+        {
+            "$set": {
+                "status": STATUS_SENT,
+                "sentAt": timeNow,
+                "expiresAt": timeNow
+                + datetime.timedelta(seconds=FINISHED_JOBS_TTL),
+            },
+            "$unset": {"messages": ""},
+        },
+    )
+    return [
+        (alert["alertID"], job["chatID"], alert["endDate"])
+        for job in jobs
+        for alert in job["alerts"]
+    ]
+
+
+def fail_jobs(failures):
+    """Reschedule jobs that hit transient errors with exponential backoff, giving up on those that were attempted MAX_ATTEMPTS times.
+
+    Parameters
+    --------
+    failures : list : tuple
+        (job, nSent, error) of each failed job, nSent being how many of its messages were sent before the error.
+    """
+
+    if not failures:
+        return
+
+    timeNow = arrow.utcnow().datetime
+    operations = []
+    for job, nSent, error in failures:
+        update = {"nSent": job["nSent"] + nSent, "lastError": str(error)}
+        if job["attempts"] >= MAX_ATTEMPTS:
+            modelsLogger.error(
+                f"Giving up on job {job['_id']} for chat {job['chatID']}: {error}"
+            )
+            update["status"] = STATUS_FAILED
+            update["expiresAt"] = timeNow + datetime.timedelta(
+                seconds=FINISHED_JOBS_TTL
+            )
+        else:
+            backoff = min(BACKOFF_BASE * 2 ** (job["attempts"] - 1), BACKOFF_MAX)
+            update["availableAt"] = timeNow + datetime.timedelta(seconds=backoff)
+        operations.append(pymongo.UpdateOne({"_id": job["_id"]}, {"$set": update}))
+
+    db.INMETBotDB.outboxCollection.bulk_write(operations, ordered=False)
+
+
+def drop_jobs(failures):
+    """Give up on jobs that can't ever be sent (e.g. the chat blocked the bot, or Telegram rejected the message).
+
+    Parameters
+    --------
+    failures : list : tuple
+        (job, error) of each job.
+    """
+
+    if not failures:
+        return
+
+    expiresAt = arrow.utcnow().datetime + datetime.timedelta(seconds=FINISHED_JOBS_TTL)
+    operations = [
+        pymongo.UpdateOne(
+            {"_id": job["_id"]},
+            {
+                "$set": {
+                    "status": STATUS_FAILED,
+                    "lastError": str(error),
+                    "expiresAt": expiresAt,
+                }
+            },
+        )
+        for job, error in failures
+    ]
+    db.INMETBotDB.outboxCollection.bulk_write(operations, ordered=False)
@@ -1,9 +1,122 @@
 import os
 import logging
+import datetime
+import arrow
 import pymongo
 
 MONGO_URI = os.getenv("INMETBOT_MONGO_URI")
 
+# Indexes for each collection; increase INDEXES_VERSION whenever they change so they are ensured again on startup
+INDEXES_VERSION = 6
+INDEXES = {
+    "Alerts": [
+        pymongo.IndexModel("alertID", unique=True),
+        pymongo.IndexModel("guid"),
+        pymongo.IndexModel("cities"),
+        pymongo.IndexModel(
+            [("severity", pymongo.ASCENDING), ("endDate", pymongo.ASCENDING)]
+        ),
+        # Past alerts are deleted by MongoDB as soon as their endDate is reached
+        pymongo.IndexModel("endDate", expireAfterSeconds=0),
+        pymongo.IndexModel(
+            "fannedOut", partialFilterExpression={"fannedOut": False}
+        ),
+    ],
+    "SubscribedChats": [
+        pymongo.IndexModel("chatID", unique=True),
+    ],
+    "Notifications": [
+        pymongo.IndexModel(
+            [("alertID", pymongo.ASCENDING), ("chatID", pymongo.ASCENDING)],
+            unique=True,
+        ),
+        pymongo.IndexModel("expiresAt", expireAfterSeconds=0),
+    ],
+    "CityChats": [
+        pymongo.IndexModel(
+            [("city", pymongo.ASCENDING), ("chatID", pymongo.ASCENDING)],
+            unique=True,
+        ),
+        pymongo.IndexModel("chatID"),
+    ],
+    "CEPCache": [
+        pymongo.IndexModel("expiresAt", expireAfterSeconds=0),
+    ],
+    "Outbox": [
+        pymongo.IndexModel(
+            [("status", pymongo.ASCENDING), ("availableAt", pymongo.ASCENDING)]
+        ),
+        pymongo.IndexModel("alerts.alertID"),
+        # Pending jobs expire along with their alerts, finished ones a day after being sent
+        pymongo.IndexModel("expiresAt", expireAfterSeconds=0),
+    ],
+}
+
+# Queries issued by the bot (with sample values) as (description, collection, filter, sort), checked by `python manage.py explain`
+QUERIES = [
+    ("Known alerts by guid", "Alerts", {"guid": {"$in": ["sample"]}}, None),
+    ("Known alerts by ID", "Alerts", {"alertID": {"$in": ["sample"]}}, None),
+    ("Alerts for a city", "Alerts", {"cities": "Vitória"}, None),
+    (
+        "Active alerts for a chat's cities",
+        "Alerts",
+        {
+            "cities": {"$in": ["Vitória"]},
+            "endDate": {"$gt": datetime.datetime(2000, 1, 1)},
+        },
+        None,
+    ),
+    ("Severe alerts for Brazil", "Alerts", {"severity": {"$ne": "Moderate"}}, None),
+    (
+        "Past alerts",
+        "Alerts",
+        {"endDate": {"$lt": datetime.datetime(2000, 1, 1)}},
+        None,
+    ),
+    ("Alerts not fanned out yet", "Alerts", {"fannedOut": False}, None),
+    (
+        "Alerts just inserted, not fanned out yet",
+        "Alerts",
+        {"fannedOut": False, "alertID": {"$in": ["sample"]}},
+        None,
+    ),
+    (
+        "Chats subscribed to cities",
+        "CityChats",
+        {"city": {"$in": ["Vitória"]}},
+        None,
+    ),
+    ("Cities of a chat", "CityChats", {"chatID": 0}, None),
+    ("Chat by ID", "SubscribedChats", {"chatID": 0}, None),
+    (
+        "Activated chats by ID",
+        "SubscribedChats",
+        {"chatID": {"$in": [0]}, "activated": {"$ne": False}},
+        None,
+    ),
+    (
+        "Alerts already notified to chats",
+        "Notifications",
+        {"alertID": {"$in": ["sample"]}, "chatID": {"$in": [0]}},
+        None,
+    ),
+    (
+        "Notifications due to be sent",
+        "Outbox",
+        {"status": "pending", "availableAt": {"$lte": datetime.datetime(2000, 1, 1)}},
+        {"availableAt": pymongo.ASCENDING},
+    ),
+    (
+        "Notifications queued for alerts",
+        "Outbox",
+        {
+            "alerts.alertID": {"$in": ["sample"]},
+            "chatID": {"$in": [0]},
+            "status": "pending",
+        },
+        None,
+    ),
+]
 
 modelsLogger = logging.getLogger(__name__)
 modelsLogger.setLevel(logging.DEBUG)
@@ -22,6 +135,16 @@ class BotDatabase:
         the Alerts collection.
     subscribedChatsCollection : Collection
         the SubscribedChats collection.
+    notificationsCollection : Collection
+        the Notifications collection (ledger of which chats were notified about which alerts).
+    cityChatsCollection : Collection
+        the CityChats collection (which chats are subscribed to which cities).
+    cepCacheCollection : Collection
+        the CEPCache collection (cached viacep lookups).
+    outboxCollection : Collection
+        the Outbox collection (notifications waiting to be sent).
+    metaCollection : Collection
+        the Meta collection, which stores the database's schema version.
     """
 
     def __init__(self):
@@ -41,6 +164,17 @@ class BotDatabase:
             self.db = self.client.INMETBot
             self.alertsCollection = self.db.Alerts
             self.subscribedChatsCollection = self.db.SubscribedChats
+            self.notificationsCollection = self.db.Notifications
+            self.cityChatsCollection = self.db.CityChats
+            self.cepCacheCollection = self.db.CEPCache
+            self.outboxCollection = self.db.Outbox
+            self.metaCollection = self.db.Meta
+
+            self.ensure_indexes()
+        except pymongo.errors.OperationFailure as mongoClientErr:
+            modelsLogger.error(
+                f"Failed to create indexes for the INMETBot database: {mongoClientErr}"
+            )
         except pymongo.errors.ServerSelectionTimeoutError as mongoClientErr:
             modelsLogger.error(
                 f"Failed to connect to the INMETBot database: {mongoClientErr}"
@@ -52,5 +186,155 @@ class BotDatabase:
             )
             exit(-1)
 
+    def ensure_indexes(self):
+        """Create the indexes declared in `INDEXES` if the database's indexes are outdated.
+
+        Returns
+        --------
+            True if indexes were created, False if they were already up to date.
+        """
+
+        indexesMetadata = self.metaCollection.find_one({"_id": "indexes"}) or {}
+        if indexesMetadata.get("version", 0) >= INDEXES_VERSION:
+            return False
+
+        # Bring existing documents up to date before the indexes that depend on them are created
+        self.migrate_alert_dates()
+        self.migrate_notified_chats()
+        self.migrate_fanned_out()
+
+        for collectionName, indexes in INDEXES.items():
+            self.db[collectionName].create_indexes(indexes)
+
+        self.metaCollection.update_one(
+            {"_id": "indexes"}, {"$set": {"version": INDEXES_VERSION}}, upsert=True
+        )
+        modelsLogger.info(f"Ensured indexes (version {INDEXES_VERSION}).")
+        return True
+
+    def migrate_alert_dates(self):
+        """Convert alerts' startDate and endDate stored as strings to dates.
+
+        Returns
+        --------
+        nMigrated : int
+            Number of migrated alerts.
+        """
+
+        stringDatesQuery = {
+            "$or": [
+                {"startDate": {"$type": "string"}},
+                {"endDate": {"$type": "string"}},
+            ]
+        }
+        operations = [
+            pymongo.UpdateOne(
+                {"_id": alert["_id"]},
+                {
+                    "$set": {
+                        "startDate": arrow.get(alert["startDate"]).datetime,
+                        "endDate": arrow.get(alert["endDate"]).datetime,
+                    }
+                },
+            )
+            for alert in self.alertsCollection.find(
+                stringDatesQuery, {"startDate": 1, "endDate": 1}
+            )
+        ]
+        if operations:
+            self.alertsCollection.bulk_write(operations, ordered=False)
+        modelsLogger.info(f"Migrated dates of {len(operations)} alerts.")
+        return len(operations)
+
+    def migrate_notified_chats(self):
+        """Move alerts' notifiedChats arrays to the Notifications collection.
+
+        Returns
+        --------
+        nMigrated : int
+            Number of migrated alerts.
+        """
+
+        alerts = list(
+            self.alertsCollection.find(
+                {"notifiedChats": {"$exists": True}},
+                {"alertID": 1, "endDate": 1, "notifiedChats": 1},
+            )
+        )
+
+        timeNow = arrow.utcnow().datetime
+        notificationDocuments = [
+            {
+                "alertID": alert["alertID"],
+                "chatID": chatID,
+                "notifiedAt": timeNow,
+                "expiresAt": arrow.get(alert["endDate"]).datetime,
+            }
+            for alert in alerts
+            for chatID in alert["notifiedChats"]
+        ]
+        if notificationDocuments:
+            self.notificationsCollection.insert_many(
+                notificationDocuments, ordered=False
+            )
+        if alerts:
+            self.alertsCollection.update_many(
+                {"_id": {"$in": [alert["_id"] for alert in alerts]}},
+                {"$unset": {"notifiedChats": ""}},
+            )
+
+        modelsLogger.info(f"Migrated notified chats of {len(alerts)} alerts.")
+        return len(alerts)
+
+    def migrate_fanned_out(self):
+        """Flag alerts stored without fannedOut as not fanned out, so chats that haven't been notified about them yet are.
+
+        Returns
+        --------
+        nMigrated : int
+            Number of migrated alerts.
+        """
+
+        result = self.alertsCollection.update_many(
+            {"fannedOut": {"$exists": False}}, {"$set": {"fannedOut": False}}
+        )
+        modelsLogger.info(f"Migrated fannedOut of {result.modified_count} alerts.")
+        return result.modified_count
+
+    def explain_query(self, collectionName, query, sort=None):
+        """Explain how the database executes `query` on `collectionName`, sorted by `sort` (if given).
+
+        Returns
+        --------
+        stats : dict
+            The winning plan's stages (e.g. "IXSCAN", "COLLSCAN") and its execution stats.
+        """
+
+        findCommand = {"find": collectionName, "filter": query}
+        if sort:
+            findCommand["sort"] = sort
+        explanation = self.db.command(
+            "explain", findCommand, verbosity="executionStats"
+        )
+
+        # Newer servers wrap the plan in "queryPlan"
+        winningPlan = explanation["queryPlanner"]["winningPlan"]
+        plan = winningPlan.get("queryPlan", winningPlan)
+        stages = []
+        while plan:
+            stages.append(plan["stage"])
+            plan = plan.get("inputStage") or next(
+                iter(plan.get("inputStages", [])), None
+            )
+
+        executionStats = explanation["executionStats"]
+        return {
+            "stages": stages,
+            "nReturned": executionStats["nReturned"],
+            "totalKeysExamined": executionStats["totalKeysExamined"],
+            "totalDocsExamined": executionStats["totalDocsExamined"],
+            "executionTimeMillis": executionStats["executionTimeMillis"],
+        }
+
 
 INMETBotDB = BotDatabase()
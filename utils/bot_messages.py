@@ -1,7 +1,6 @@
 # Plain strings for the bot
 
 ALERTAS_URL = "https://alertas2.inmet.gov.br/"
-MAX_ALERTS_PER_MESSAGE = 6  # To avoid "message is too long" Telegram error
 
 
 welcomeMessage = """*🌥 @INMETBot*
@@ -1,18 +1,19 @@
 import os
+import time
 import logging
+import threading
 from io import BytesIO
 import uuid
-import base64
 import hashlib
 from functools import wraps
 import imageio
+import numpy as np
 import telegram
 from PIL import Image
 import arrow
-import fgrequests
 import pycep_correios as pycep
 
-from utils import bot_messages
+from utils import bot_messages, message_packer, satellite_frames, image_data
 from models.Alert import Alert
 
 
@@ -23,13 +24,31 @@ utilsLogger.setLevel(logging.DEBUG)
 MIN_VPR_IMAGES = 2
 DEFAULT_VPR_IMAGES = 13  # ~2 hours of images
 MAX_VPR_IMAGES = 72  # ~12 hours of images
+# Image formats sent to Telegram as they are (with their file extensions); others are transcoded to JPEG
+PASSTHROUGH_IMAGE_TYPES = {"image/jpeg": "jpeg", "image/png": "png"}
+# Numbers of images whose VPR animations are kept rendered, rebuilt whenever a new frame lands
+PRERENDERED_VPR_IMAGES = [DEFAULT_VPR_IMAGES, 6, 24, 36]
 
 
 
 def loadB64ImageToMemory(base64String):
-    # Decode Base64 image
-    base64data = base64String[21:]  # Remove string header
-    image = Image.open(BytesIO(base64.b64decode(base64data)))
+    # Decode Base64 image, reading its format from the data URI's header
+    mimeType, imageBytes = image_data.decode_data_uri(base64String)
+    return loadImageBytesToMemory(imageBytes, mimeType)
+
+
+def loadImageBytesToMemory(imageBytes, mimeType=None):
+    """Load image to memory to be sent to Telegram, as is if Telegram accepts its format or transcoded to JPEG otherwise."""
+
+    mimeType = mimeType or image_data.sniff_image_type(imageBytes)
+    if mimeType in PASSTHROUGH_IMAGE_TYPES:
+        # Hand the original bytes through (BytesIO doesn't copy them unless written to)
+        bytesIOImage = BytesIO(imageBytes)
+        bytesIOImage.name = f"image.{PASSTHROUGH_IMAGE_TYPES[mimeType]}"
+        return bytesIOImage
+
+    utilsLogger.debug(f"Transcoding {mimeType} image to JPEG.")
+    image = Image.open(BytesIO(imageBytes)).convert("RGB")
 
     # Save image to memory
     bytesIOImage = BytesIO()
@@ -40,57 +59,152 @@ def loadB64ImageToMemory(base64String):
     return bytesIOImage
 
 
-def get_vpr_images_data(
-    data, nImages, dayNow, nImagesForYesterday=None, dataYesterday=None
-):
-    regiao = "BR"
-    APIBaseURL = "https://apisat.inmet.gov.br"
+def get_vpr_images_data(nImages):
+    """Get the latest `nImages` VPR frames, newest first, from the shared frame store (apisat is only hit for frames it doesn't have yet)."""
 
-    URLsToBeRequested = []
+    return satellite_frames.get_latest_frames(nImages)
 
-    for hourToday in data[:nImages]:
-        URLsToBeRequested.append(
-            f"{APIBaseURL}/GOES/{regiao}/VP/{dayNow}/{hourToday['sigla']}"
-        )
 
-    if dataYesterday:
-        nImages = nImages + nImagesForYesterday
+def create_gif_vpr_data(frames, nImages):
+    """Encode the latest `nImages` frames (`frames` being newest first) into an .mp4 file, in chronological order.
 
-        for hour in dataYesterday[:nImagesForYesterday]:
-            URLsToBeRequested.append(
-                f"{APIBaseURL}/GOES/{regiao}/VP/{arrow.utcnow().shift(days=-1).format('YYYY-MM-DD')}/{hour['sigla']}"
-            )
+    Frames are decoded and streamed into the encoder one at a time, so only one decoded frame is held in memory regardless of `nImages`.
+
+    Returns
+    --------
+    gifFilename : str
+        Path to the .mp4 file.
+    """
+
+    uniqueID = uuid.uuid4().hex
+    gifFilename = os.path.join("tmp", f"VPR_{uniqueID}.mp4")
 
-    responses = list(
-        filter(lambda x: x.status_code == 200, fgrequests.build(URLsToBeRequested))
+    startTime = time.perf_counter()
+    peakFrameBytes = 0
+    kargs = {"fps": 10, "macro_block_size": None}
+    try:
+        with imageio.get_writer(gifFilename, "MP4", mode="I", **kargs) as writer:
+            for frame in reversed(frames[:nImages]):
+                # Decode the original bytes straight into the encoder, as RGB (palette and RGBA PNGs would give the encoder frames of other shapes)
+                image = np.asarray(Image.open(BytesIO(frame.image)).convert("RGB"))
+                peakFrameBytes = max(peakFrameBytes, image.nbytes)
+                writer.append_data(image)
+                del image
+    except Exception:
+        if os.path.exists(gifFilename):
+            os.remove(gifFilename)
+        raise
+
+    utilsLogger.info(
+        f"Encoded {min(nImages, len(frames))} frames into {gifFilename} in "
+        f"{time.perf_counter() - startTime:.2f}s "
+        f"(peak decoded frame memory: {peakFrameBytes / 1024 / 1024:.1f} MB)."
     )
-    responseData = [entry.json() for entry in responses]
+    return gifFilename
 
-    return responseData
 
+class VPRAnimations:
+    """The VPRAnimations object keeps VPR animations of the latest frames rendered for the most common numbers of images, so most /nuvens calls don't have to encode one.
 
-def create_gif_vpr_data(data, nImages):
-    readImages = []
-    for entry in reversed(data[:nImages]):
-        loadedImg = loadB64ImageToMemory(entry["base64"])
-        readImages.append(imageio.imread(loadedImg))
+    The files of the previous generation are only deleted when the next one is rendered, so animations being sent aren't deleted under them.
 
-    uniqueID = uuid.uuid4().hex
-    gifFilename = os.path.join("tmp", f"VPR_{uniqueID}.mp4")
+    Attributes
+    ----------
+    animations : dict
+        (path, frames) of the rendered animation of each number of images.
+    """
 
-    kargs = {"fps": 10, "macro_block_size": None}
-    imageio.mimsave(f"{gifFilename}", readImages, "MP4", **kargs)
+    def __init__(self):
+        self.animations = {}
+        self.previousPaths = []
+        self.lock = threading.Lock()
 
-    return gifFilename
+    def get(self, nImages):
+        """Get the rendered animation of the latest `nImages` frames, or None if there isn't an up-to-date one.
+
+        Returns
+        --------
+        (path, frames) : tuple
+            Path to the .mp4 file and the frames in it, newest first.
+        """
+
+        with self.lock:
+            animation = self.animations.get(nImages)
+        if animation is None:
+            return None
+
+        path, frames = animation
+        latestKeys = satellite_frames.get_latest_frames_keys(nImages)
+        framesKeys = [(frame.region, frame.date, frame.hour) for frame in frames]
+        if framesKeys != latestKeys:
+            return None
+        return animation
+
+    def render(self):
+        """Render the animations of the latest frames that are outdated.
+
+        Returns
+        --------
+        nRendered : int
+            Number of animations rendered.
+        """
+
+        nRendered = 0
+        renderedPaths = []
+        for nImages in PRERENDERED_VPR_IMAGES:
+            if self.get(nImages):
+                continue
+
+            frames = get_vpr_images_data(nImages)
+            if len(frames) < nImages:
+                continue
+            path = create_gif_vpr_data(frames, nImages)
+
+            with self.lock:
+                previousAnimation = self.animations.get(nImages)
+                self.animations[nImages] = (path, frames)
+            if previousAnimation:
+                renderedPaths.append(previousAnimation[0])
+            nRendered += 1
+
+        # Delete the generation before the one just replaced
+        with self.lock:
+            stalePaths, self.previousPaths = self.previousPaths, renderedPaths
+        for stalePath in stalePaths:
+            try:
+                os.remove(stalePath)
+            except OSError as error:
+                utilsLogger.warning(f"Failed to delete {stalePath}: {error}")
+        return nRendered
+
+
+def prefetch_vpr_routine():
+    """Prefetch new VPR frames and, if any landed, render the common animations again.
+
+    Returns
+    --------
+    newFrames : bool
+        True if any new frame was downloaded, False otherwise.
+    """
+
+    newFrames = satellite_frames.prefetch_frames_routine()
+    if newFrames or not vprAnimations.animations:
+        startTime = time.perf_counter()
+        nRendered = vprAnimations.render()
+        utilsLogger.info(
+            f"Rendered {nRendered} VPR animations in {time.perf_counter() - startTime:.2f}s."
+        )
+    return newFrames
+
+
+vprAnimations = VPRAnimations()
 
 
 # Unused
-def get_vpr_gif(data, nImages, dayNow, nImagesForYesterday=None, dataYesterday=None):
-    vprResponse = get_vpr_images_data(
-        data, nImages, dayNow, nImagesForYesterday, dataYesterday
-    )
+def get_vpr_gif(nImages):
+    vprFrames = get_vpr_images_data(nImages)
 
-    return create_gif_vpr_data(vprResponse, nImages)
+    return create_gif_vpr_data(vprFrames, nImages)
 
 
 def check_and_send_alerts_warning(update, context, alerts, city=None):
@@ -103,45 +217,37 @@ def check_and_send_alerts_warning(update, context, alerts, city=None):
     """
 
     warned = False
-    alertMessage = ""
-    alertCounter = 0
 
     if alerts:
-        for alert in alerts:
-            alertObj = Alert(alertDict=alert)
-            alertMessage += alertObj.get_alert_message(
+        alertsMessages = [
+            Alert(alertDict=alert).get_alert_message(
                 location=city, brazil=not (bool(city))
             )
-            alertCounter += 1
-
-            if alertCounter >= bot_messages.MAX_ALERTS_PER_MESSAGE:
-                context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    reply_to_message_id=update.message.message_id,
-                    text=alertMessage,
-                    parse_mode="markdown",
-                    disable_web_page_preview=True,
-                )
-                alertMessage = ""
-                alertCounter = 0
+            for alert in alerts
+        ]
         warned = True
 
         # "Footer" message after all alerts
-        alertMessage += bot_messages.moreInfoAlertAS
+        messages = message_packer.pack_messages(
+            alertsMessages, bot_messages.moreInfoAlertAS
+        )
     elif not city:
-        alertMessage = bot_messages.noAlertsBrazil
+        messages = [bot_messages.noAlertsBrazil]
     else:
-        alertMessage = bot_messages.noAlertsCity.format(
-            city=city, ALERTAS_URL=bot_messages.ALERTAS_URL
-        )
+        messages = [
+            bot_messages.noAlertsCity.format(
+                city=city, ALERTAS_URL=bot_messages.ALERTAS_URL
+            )
+        ]
 
-    context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        reply_to_message_id=update.message.message_id,
-        text=alertMessage,
-        parse_mode="markdown",
-        disable_web_page_preview=True,
-    )
+    for alertMessage in messages:
+        context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            reply_to_message_id=update.message.message_id,
+            text=alertMessage,
+            parse_mode="markdown",
+            disable_web_page_preview=True,
+        )
 
     return warned
 
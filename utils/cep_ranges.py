@@ -0,0 +1,177 @@
+# This file contains an optional offline table of CEP ranges and their municipalities, so CEPs can be resolved without querying viacep.
+# The table is a CSV file with the columns cepStart, cepEnd, city, UF and IBGE (one row per CEP range) at CEP_RANGES_PATH.
+
+import os
+import csv
+import time
+import random
+import logging
+import threading
+from array import array
+from bisect import bisect_right
+
+cepRangesLogger = logging.getLogger(__name__)
+cepRangesLogger.setLevel(logging.DEBUG)
+
+CEP_RANGES_PATH = os.getenv(
+    "INMETBOT_CEP_RANGES_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "cep_ranges.csv"),
+)
+CEP_RANGES_FIELDS = ["cepStart", "cepEnd", "city", "UF", "IBGE"]
+
+
+class CEPRanges:
+    """The CEPRanges object resolves CEPs to municipalities with a binary search over sorted CEP ranges.
+
+    Ranges are stored in two compact arrays of unsigned ints (starts and ends), and each range points to a (city, UF, IBGE) tuple shared by all ranges of the same municipality.
+
+    Parameters
+    ----------
+    rows : list : dict
+        Rows with the fields in CEP_RANGES_FIELDS.
+    """
+
+    def __init__(self, rows=()):
+        self.starts = array("I")
+        self.ends = array("I")
+        self.locationIndexes = array("I")
+        self.locations = []
+
+        locationsIndexes = {}
+        for row in sorted(rows, key=lambda row: int(row["cepStart"])):
+            cepStart, cepEnd = int(row["cepStart"]), int(row["cepEnd"])
+            if cepStart > cepEnd:
+                raise ValueError(f"Invalid CEP range {cepStart}-{cepEnd}")
+            if self.ends and cepStart <= self.ends[-1]:
+                raise ValueError(f"CEP range {cepStart}-{cepEnd} overlaps another")
+
+            location = (row["city"], row["UF"], row["IBGE"])
+            if location not in locationsIndexes:
+                locationsIndexes[location] = len(self.locations)
+                self.locations.append(location)
+
+            self.starts.append(cepStart)
+            self.ends.append(cepEnd)
+            self.locationIndexes.append(locationsIndexes[location])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, CEPString):
+        """Get the (city, UF, IBGE) of the municipality whose range contains the CEP, or None if no range does."""
+
+        cep = int(CEPString)
+        i = bisect_right(self.starts, cep) - 1
+        if i >= 0 and cep <= self.ends[i]:
+            return self.locations[self.locationIndexes[i]]
+        return None
+
+    def rows(self):
+        """Iterate over the table's rows, sorted by cepStart."""
+
+        for cepStart, cepEnd, locationIndex in zip(
+            self.starts, self.ends, self.locationIndexes
+        ):
+            city, UF, IBGE = self.locations[locationIndex]
+            yield {
+                "cepStart": f"{cepStart:08d}",
+                "cepEnd": f"{cepEnd:08d}",
+                "city": city,
+                "UF": UF,
+                "IBGE": IBGE,
+            }
+
+
+def read_cep_ranges(path):
+    """Read and validate a CEP ranges CSV file.
+
+    Returns
+    --------
+    cepRanges : CEPRanges
+        The table, raising ValueError if the file has invalid or overlapping ranges.
+    """
+
+    with open(path, newline="", encoding="utf-8") as cepRangesFile:
+        return CEPRanges(csv.DictReader(cepRangesFile))
+
+
+def load_cep_ranges(sourcePath, path=CEP_RANGES_PATH):
+    """Validate the CEP ranges in `sourcePath` and store them, sorted, as the table used by the bot.
+
+    Returns
+    --------
+    nRanges : int
+        Number of CEP ranges stored.
+    """
+
+    global cepRangesTable
+
+    cepRanges = read_cep_ranges(sourcePath)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", newline="", encoding="utf-8") as cepRangesFile:
+        writer = csv.DictWriter(cepRangesFile, fieldnames=CEP_RANGES_FIELDS)
+        writer.writeheader()
+        writer.writerows(cepRanges.rows())
+
+    with cepRangesLock:
+        cepRangesTable = cepRanges
+    return len(cepRanges)
+
+
+def get_cep_ranges():
+    """Get the CEP ranges table, reading it on first use. The table is empty if there's no file at CEP_RANGES_PATH."""
+
+    global cepRangesTable
+
+    with cepRangesLock:
+        if cepRangesTable is None:
+            try:
+                cepRangesTable = read_cep_ranges(CEP_RANGES_PATH)
+                cepRangesLogger.info(
+                    f"Loaded {len(cepRangesTable)} CEP ranges from {CEP_RANGES_PATH}."
+                )
+            except FileNotFoundError:
+                cepRangesTable = CEPRanges()
+            except (ValueError, KeyError) as error:
+                cepRangesLogger.error(f"Invalid CEP ranges table: {error}")
+                cepRangesTable = CEPRanges()
+        return cepRangesTable
+
+
+def lookup_cep(CEPString):
+    """Get the (city, UF, IBGE) of the CEP from the offline table, or None if it isn't in it."""
+
+    return get_cep_ranges().lookup(CEPString)
+
+
+def benchmark(nLookups=100000):
+    """Measure the table's lookup latency with random CEPs.
+
+    Returns
+    --------
+    stats : dict
+        Number of ranges, lookups and hits, and the mean lookup time in microseconds.
+    """
+
+    cepRanges = get_cep_ranges()
+    CEPs = [f"{random.randrange(100000000):08d}" for _ in range(nLookups)]
+
+    start = time.perf_counter()
+    nHits = sum(1 for cep in CEPs if cepRanges.lookup(cep) is not None)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "nRanges": len(cepRanges),
+        "nLookups": nLookups,
+        "nHits": nHits,
+        "meanMicroseconds": elapsed / nLookups * 1e6,
+    }
+
+
+cepRangesLock = threading.Lock()
+cepRangesTable = None
+
+
+if __name__ == "__main__":
+    print(benchmark())
@@ -0,0 +1,208 @@
+# This file contains the delivery engine used to send alert notifications to many chats concurrently within Telegram's rate limits.
+
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from telegram.error import RetryAfter, BadRequest, NetworkError
+
+deliveryLogger = logging.getLogger(__name__)
+deliveryLogger.setLevel(logging.DEBUG)
+
+# Telegram's rate limits (messages per second)
+GLOBAL_RATE = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+# Number of messages being sent concurrently
+DELIVERY_WORKERS = 16
+# Number of times a message is retried after timeouts/network errors or flood control (429)
+MAX_RETRIES = 5
+
+
+class TokenBucket:
+    """The TokenBucket object limits how often something can happen: each call to `acquire` takes a token, and tokens are refilled at `rate` tokens per second up to `capacity`.
+
+    Parameters
+    ----------
+    rate : float
+        Tokens refilled per second.
+    capacity : float
+        Maximum number of tokens (i.e. maximum burst). Defaults to 1.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updatedAt = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, even if it isn't available yet.
+
+        Returns
+        --------
+        waitTime : float
+            Time (in seconds) until the token is available.
+        """
+
+        with self.lock:
+            timeNow = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (timeNow - self.updatedAt) * self.rate
+            )
+            self.updatedAt = timeNow
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        """Take a token, waiting until it is available."""
+
+        waitTime = self.reserve()
+        if waitTime > 0:
+            time.sleep(waitTime)
+
+    def pause(self, seconds):
+        """Don't give out tokens for `seconds` (e.g. after Telegram's flood control kicks in)."""
+
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class DeliveryEngine:
+    """The DeliveryEngine object sends messages to many chats concurrently, respecting Telegram's global, per-chat and per-group rate limits.
+
+    Messages to the same chat are sent in order by a single worker.
+
+    Parameters
+    ----------
+    bot : telegram.Bot
+        The bot that sends the messages.
+    nWorkers : int
+        Number of messages being sent concurrently. Defaults to `DELIVERY_WORKERS`.
+
+    Attributes
+    ----------
+    globalBucket : TokenBucket
+        Limits the messages sent by the bot as a whole.
+    chatsBuckets : dict
+        Limits the messages sent to each chat, keyed by chat ID.
+    """
+
+    def __init__(self, bot, nWorkers=DELIVERY_WORKERS):
+        self.bot = bot
+        self.nWorkers = nWorkers
+        self.globalBucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.chatsBuckets = {}
+        self.lock = threading.Lock()
+
+    def get_chat_bucket(self, chatID):
+        """Get the token bucket of the chat (groups have negative IDs and a lower rate limit)."""
+
+        with self.lock:
+            if chatID not in self.chatsBuckets:
+                rate = GROUP_CHAT_RATE if chatID < 0 else PRIVATE_CHAT_RATE
+                self.chatsBuckets[chatID] = TokenBucket(rate)
+            return self.chatsBuckets[chatID]
+
+    def send_message(self, chatID, text, **kwargs):
+        """Send message to chat within the rate limits, retrying after flood control (429) and network errors.
+
+        Other errors (e.g. the bot was blocked) are raised.
+        """
+
+        chatBucket = self.get_chat_bucket(chatID)
+        for attempt in range(MAX_RETRIES + 1):
+            chatBucket.acquire()
+            self.globalBucket.acquire()
+            try:
+                return self.bot.send_message(chat_id=chatID, text=text, **kwargs)
+            except RetryAfter as error:
+                if attempt == MAX_RETRIES:
+                    raise
+                deliveryLogger.warning(
+                    f"Flood control while sending to {chatID}; retrying in {error.retry_after}s."
+                )
+                self.globalBucket.pause(error.retry_after)
+                chatBucket.pause(error.retry_after)
+            except BadRequest:
+                # BadRequest is a NetworkError, but retrying won't help
+                raise
+            except NetworkError as error:
+                if attempt == MAX_RETRIES:
+                    raise
+                deliveryLogger.warning(
+                    f"Network error while sending to {chatID} ({error}); retrying."
+                )
+                time.sleep(2 ** attempt)
+
+    def deliver_chat(self, job, stats, enqueuedAt):
+        """Send a chat's messages in order, stopping at the first one that fails.
+
+        Returns
+        --------
+        (nSent, error) : tuple
+            Number of messages sent and the error that stopped the delivery (None if all messages were sent).
+        """
+
+        chatID, messages = job
+        for i, message in enumerate(messages):
+            try:
+                self.send_message(
+                    chatID,
+                    message,
+                    parse_mode="markdown",
+                    disable_web_page_preview=True,
+                )
+            except Exception as error:
+                with self.lock:
+                    stats["nFailed"] += len(messages) - i
+                return (i, error)
+
+            latency = time.perf_counter() - enqueuedAt
+            with self.lock:
+                stats["nSent"] += 1
+                stats["totalLatency"] += latency
+                stats["maxLatency"] = max(stats["maxLatency"], latency)
+        return (len(messages), None)
+
+    def deliver(self, jobs):
+        """Send messages to many chats concurrently and wait until they are all sent.
+
+        Parameters
+        --------
+        jobs : list : tuple
+            (chatID, messages) for each chat, where messages is a list of Markdown strings.
+
+        Returns
+        --------
+        stats : dict
+            Number of messages sent and failed, elapsed time, throughput (messages per second), mean/max queue latency (seconds from being queued to being sent) and the (nSent, error) result of each job, in order.
+        """
+
+        stats = {"nSent": 0, "nFailed": 0, "totalLatency": 0, "maxLatency": 0}
+        startTime = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.nWorkers) as executor:
+            futures = [
+                executor.submit(self.deliver_chat, job, stats, startTime)
+                for job in jobs
+            ]
+            wait(futures)
+        stats["results"] = [future.result() for future in futures]
+
+        elapsedTime = time.perf_counter() - startTime
+        stats["elapsedTime"] = elapsedTime
+        stats["throughput"] = stats["nSent"] / elapsedTime if elapsedTime else 0
+        stats["meanLatency"] = (
+            stats.pop("totalLatency") / stats["nSent"] if stats["nSent"] else 0
+        )
+        deliveryLogger.info(
+            f"Delivered {stats['nSent']} messages to {len(jobs)} chats "
+            f"({stats['nFailed']} failed) in {elapsedTime:.2f}s: "
+            f"{stats['throughput']:.1f} msg/s, queue latency "
+            f"mean {stats['meanLatency']:.2f}s, max {stats['maxLatency']:.2f}s."
+        )
+        return stats
@@ -0,0 +1,41 @@
+# This file contains helpers to decode images sent by INMET's APIs as base64 data URIs (e.g. "data:image/png;base64,iVBOR...").
+
+import base64
+
+# Signatures of the image formats INMET's APIs send
+IMAGE_SIGNATURES = {
+    b"\xff\xd8\xff": "image/jpeg",
+    b"\x89PNG\r\n\x1a\n": "image/png",
+    b"GIF8": "image/gif",
+}
+
+
+def decode_data_uri(dataURI):
+    """Decode a base64 data URI.
+
+    Returns
+    --------
+    (mimeType, data) : tuple
+        The MIME type declared in the data URI's header (or sniffed from the data, if it has no header) and the decoded bytes.
+    """
+
+    header, separator, encodedData = dataURI.partition(",")
+    if not separator:
+        # No header, only data
+        data = base64.b64decode(header)
+        return (sniff_image_type(data), data)
+
+    mimeType = ""
+    if header.startswith("data:"):
+        mimeType = header[len("data:") :].split(";")[0]
+    data = base64.b64decode(encodedData)
+    return (mimeType or sniff_image_type(data), data)
+
+
+def sniff_image_type(data):
+    """Get the MIME type of an image from its first bytes, or None if the format is unknown."""
+
+    for signature, mimeType in IMAGE_SIGNATURES.items():
+        if data.startswith(signature):
+            return mimeType
+    return None
@@ -0,0 +1,115 @@
+# This file contains the cache of Telegram file_ids of media sent by the bot, so the same image or video is only uploaded once.
+
+import logging
+import threading
+from collections import OrderedDict
+
+from telegram.error import BadRequest
+
+mediaLogger = logging.getLogger(__name__)
+mediaLogger.setLevel(logging.DEBUG)
+
+# Maximum number of file_ids kept
+MEDIA_CACHE_SIZE = 512
+
+
+class MediaCache:
+    """The MediaCache object maps media (keyed by product and timestamp, e.g. ("vpr", "BR", "2021-05-01", "12:10"), or by content hash) to the file_id Telegram returned when it was first uploaded.
+
+    New imagery gets new keys; the least recently used keys are evicted once there are more than `maxSize`.
+
+    Parameters
+    ----------
+    maxSize : int
+        Maximum number of file_ids kept. Defaults to `MEDIA_CACHE_SIZE`.
+
+    Attributes
+    ----------
+    stats : dict
+        Number of hits (media sent by file_id), misses (media uploaded) and invalidations.
+    """
+
+    def __init__(self, maxSize=MEDIA_CACHE_SIZE):
+        self.maxSize = maxSize
+        self.fileIDs = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, key):
+        """Get the file_id of the media, or None."""
+
+        with self.lock:
+            fileID = self.fileIDs.get(key)
+            if fileID is not None:
+                self.fileIDs.move_to_end(key)
+            return fileID
+
+    def put(self, key, fileID):
+        """Store the file_id of the media."""
+
+        with self.lock:
+            self.fileIDs[key] = fileID
+            self.fileIDs.move_to_end(key)
+            if len(self.fileIDs) > self.maxSize:
+                self.fileIDs.popitem(last=False)
+
+    def invalidate(self, key):
+        """Forget the file_id of the media."""
+
+        with self.lock:
+            if self.fileIDs.pop(key, None) is not None:
+                self.stats["invalidations"] += 1
+
+    def send(self, key, sendFunc, loadMedia):
+        """Send media by its file_id if it was already uploaded, uploading it otherwise.
+
+        Parameters
+        --------
+        key : tuple
+            Key of the media. If None, the media is always uploaded.
+        sendFunc : function
+            Sends the media (a file_id or a file) and returns the sent message, e.g. `lambda media: bot.send_photo(chat_id, photo=media)`.
+        loadMedia : function
+            Returns the media to be uploaded (only called if it wasn't uploaded yet).
+
+        Returns
+        --------
+        message : telegram.Message
+            The sent message.
+        """
+
+        if key is None:
+            return sendFunc(loadMedia())
+
+        fileID = self.get(key)
+        if fileID is not None:
+            try:
+                message = sendFunc(fileID)
+                self.stats["hits"] += 1
+                return message
+            except BadRequest as error:
+                mediaLogger.warning(f"Invalid file_id for {key} ({error}); uploading.")
+                self.invalidate(key)
+
+        self.stats["misses"] += 1
+        message = sendFunc(loadMedia())
+        sentFileID = get_file_id(message)
+        if sentFileID:
+            self.put(key, sentFileID)
+        mediaLogger.debug(f"Uploaded {key}; stats: {self.stats}")
+        return message
+
+
+def get_file_id(message):
+    """Get the file_id of the media in a sent message, or None."""
+
+    if message.photo:
+        # Largest size
+        return message.photo[-1].file_id
+    for media in (message.animation, message.video, message.document):
+        if media:
+            return media.file_id
+    return None
+
+
+mediaCache = MediaCache()
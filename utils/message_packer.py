@@ -0,0 +1,137 @@
+# This file contains the packer that groups alert messages into as few Telegram messages as possible.
+
+import re
+import logging
+
+packerLogger = logging.getLogger(__name__)
+packerLogger.setLevel(logging.DEBUG)
+
+# Telegram's limit for a message's text, after parsing its entities (in UTF-16 code units)
+MAX_MESSAGE_LENGTH = 4096
+
+# Markdown (legacy) syntax, which doesn't count towards the limit
+MARKDOWN_LINK_PATTERN = re.compile(r"\[([^\]]*)\]\([^)]*\)")
+MARKDOWN_ENTITY_PATTERN = re.compile(r"(?<!\\)(```|[*_`])")
+MARKDOWN_ESCAPE_PATTERN = re.compile(r"\\([*_`\[])")
+
+
+def telegram_length(text):
+    """Get the length of a Markdown message as counted by Telegram: without the Markdown syntax, in UTF-16 code units."""
+
+    text = MARKDOWN_LINK_PATTERN.sub(r"\1", text)
+    text = MARKDOWN_ENTITY_PATTERN.sub("", text)
+    text = MARKDOWN_ESCAPE_PATTERN.sub(r"\1", text)
+    return len(text.encode("utf-16-le")) // 2
+
+
+def is_markdown_closed(text):
+    """Check whether every Markdown entity (bold, italic, code) opened in `text` is also closed in it."""
+
+    openMarker = None
+    for marker in MARKDOWN_ENTITY_PATTERN.findall(MARKDOWN_LINK_PATTERN.sub("", text)):
+        if openMarker is None:
+            openMarker = marker
+        elif marker == openMarker:
+            openMarker = None
+    return openMarker is None
+
+
+def strip_markdown(text):
+    """Remove the Markdown entities (but not the links) from `text`, so it can be split anywhere."""
+
+    pieces = []
+    lastEnd = 0
+    for linkMatch in MARKDOWN_LINK_PATTERN.finditer(text):
+        textBefore = text[lastEnd : linkMatch.start()]
+        pieces.append(MARKDOWN_ENTITY_PATTERN.sub("", textBefore))
+        pieces.append(linkMatch.group(0))
+        lastEnd = linkMatch.end()
+    pieces.append(MARKDOWN_ENTITY_PATTERN.sub("", text[lastEnd:]))
+    return "".join(pieces)
+
+
+def split_block(block, maxLength=MAX_MESSAGE_LENGTH):
+    """Split a block into segments that can be sent in separate messages.
+
+    The block is only split between lines after which every Markdown entity is closed, so no entity is cut in half. A segment still longer than `maxLength` loses its Markdown and is split by lines (or cut, if it is a single line).
+
+    Returns
+    --------
+    segments : list : str
+        The segments, in order.
+    """
+
+    segments = []
+    segment = ""
+    for line in block.splitlines(keepends=True):
+        segment += line
+        if is_markdown_closed(segment):
+            segments.append(segment)
+            segment = ""
+    if segment:
+        segments.append(segment)
+
+    splitSegments = []
+    for segment in segments:
+        if telegram_length(segment) <= maxLength:
+            splitSegments.append(segment)
+            continue
+
+        for line in strip_markdown(segment).splitlines(keepends=True):
+            if telegram_length(line) <= maxLength:
+                splitSegments.append(line)
+            else:
+                # A single line that is too long is cut (each character is at most 2 UTF-16 code units)
+                line = MARKDOWN_LINK_PATTERN.sub(r"\1", line)
+                splitSegments.extend(
+                    line[i : i + maxLength // 2]
+                    for i in range(0, len(line), maxLength // 2)
+                )
+    return splitSegments
+
+
+def pack_messages(blocks, footer="", maxLength=MAX_MESSAGE_LENGTH):
+    """Pack blocks (e.g. alert messages) into as few messages as possible, in order, without splitting any of them.
+
+    Each message is filled with as many blocks as fit in `maxLength`; since blocks must stay in order, this minimizes the number of messages. A block that doesn't fit in a message by itself is split by `split_block`, and its segments are packed like blocks (the first ones filling the message before it).
+
+    Parameters
+    --------
+    blocks : list : str
+        Markdown strings to be packed.
+    footer : str
+        Markdown string appended to the last message (or sent by itself if it doesn't fit).
+    maxLength : int
+        Maximum length of each message, as counted by `telegram_length`. Defaults to `MAX_MESSAGE_LENGTH`.
+
+    Returns
+    --------
+    messages : list : str
+        The packed messages.
+    """
+
+    messages = []
+    message = ""
+    messageLength = 0
+    blocks = list(blocks) + [footer] if footer else list(blocks)
+    for block in blocks:
+        blockLength = telegram_length(block)
+        if blockLength > maxLength:
+            packerLogger.warning(
+                f"Block is too long for a single message ({blockLength}); splitting it."
+            )
+            segments = split_block(block, maxLength)
+        else:
+            segments = [block]
+
+        for segment in segments:
+            segmentLength = telegram_length(segment)
+            if message and messageLength + segmentLength > maxLength:
+                messages.append(message)
+                message, messageLength = "", 0
+            message += segment
+            messageLength += segmentLength
+
+    if message:
+        messages.append(message)
+    return messages
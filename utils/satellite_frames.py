@@ -0,0 +1,226 @@
+# This file contains the store of satellite frames (GOES images from INMET's apisat) shared by /vpr and /nuvens, and the routine that prefetches new frames into it.
+
+import time
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import arrow
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils import image_data
+
+framesLogger = logging.getLogger(__name__)
+framesLogger.setLevel(logging.DEBUG)
+
+HEADERS = {
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/55.0.2883.87 Safari/537.36"
+}
+APISAT_URL = "https://apisat.inmet.gov.br"
+VPR_REGION = "BR"
+
+# Maximum size (in bytes) of the frames kept in memory
+FRAME_STORE_MAX_BYTES = 128 * 1024 * 1024
+# Time (in seconds) a day's list of available frames is reused for (a new frame is published every 10 minutes)
+FRAME_HOURS_TTL = 2 * 60
+# Number of frames downloaded concurrently
+FRAME_FETCH_WORKERS = 8
+# Timeout (in seconds) for each apisat request
+FRAME_FETCH_TIMEOUT = 20
+# Number of frames kept warm by the prefetch routine (the most /nuvens can ask for)
+PREFETCH_FRAMES = 72
+
+# A frame: its region, date ("YYYY-MM-DD", UTC), hour ("HH:mm", UTC) and decoded image bytes
+Frame = namedtuple("Frame", ["region", "date", "hour", "image"])
+
+
+class FrameStore:
+    """The FrameStore object keeps decoded frames in memory, keyed by (region, date, hour), evicting the least recently used ones once they take more than `maxBytes`.
+
+    Parameters
+    ----------
+    maxBytes : int
+        Maximum size (in bytes) of the stored frames. Defaults to `FRAME_STORE_MAX_BYTES`.
+
+    Attributes
+    ----------
+    nBytes : int
+        Size (in bytes) of the stored frames.
+    stats : dict
+        Number of hits, misses and evictions.
+    """
+
+    def __init__(self, maxBytes=FRAME_STORE_MAX_BYTES):
+        self.maxBytes = maxBytes
+        self.frames = OrderedDict()
+        self.nBytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.frames
+
+    def get(self, key):
+        """Get the frame stored for (region, date, hour), or None."""
+
+        with self.lock:
+            frame = self.frames.get(key)
+            if frame is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.frames.move_to_end(key)
+            return frame
+
+    def put(self, frame):
+        """Store frame, evicting the least recently used frames if needed."""
+
+        key = (frame.region, frame.date, frame.hour)
+        with self.lock:
+            if key in self.frames:
+                self.nBytes -= len(self.frames.pop(key).image)
+            self.frames[key] = frame
+            self.nBytes += len(frame.image)
+            while self.nBytes > self.maxBytes and len(self.frames) > 1:
+                _, evictedFrame = self.frames.popitem(last=False)
+                self.nBytes -= len(evictedFrame.image)
+                self.stats["evictions"] += 1
+
+
+def create_session(poolSize=FRAME_FETCH_WORKERS):
+    """Create a `requests.Session` whose connection pool can hold `poolSize` connections."""
+
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_frame_hours(date, region=VPR_REGION):
+    """Get the hours ("HH:mm", UTC) of the frames available for a date, newest first.
+
+    The list is reused for `FRAME_HOURS_TTL` seconds; if apisat fails, the last list fetched is used.
+    """
+
+    key = (region, date)
+    with frameHoursLock:
+        cachedHours = frameHours.get(key)
+    if cachedHours and time.monotonic() - cachedHours[0] < FRAME_HOURS_TTL:
+        return cachedHours[1]
+
+    try:
+        response = framesSession.get(
+            f"{APISAT_URL}/horas/GOES/{region}/VP/{date}",
+            timeout=FRAME_FETCH_TIMEOUT,
+        )
+        response.raise_for_status()
+        hours = [entry["sigla"] for entry in response.json()]
+    except (requests.exceptions.RequestException, ValueError, KeyError) as error:
+        framesLogger.warning(f"Failed to get frame hours for {date}: {error}")
+        return cachedHours[1] if cachedHours else []
+
+    with frameHoursLock:
+        frameHours[key] = (time.monotonic(), hours)
+    return hours
+
+
+def fetch_frame(date, hour, region=VPR_REGION):
+    """Download and decode a frame from apisat, storing it in `frameStore`.
+
+    Returns
+    --------
+    frame : Frame
+        The frame, or None if it couldn't be downloaded.
+    """
+
+    try:
+        response = framesSession.get(
+            f"{APISAT_URL}/GOES/{region}/VP/{date}/{hour}",
+            timeout=FRAME_FETCH_TIMEOUT,
+        )
+        response.raise_for_status()
+        _, image = image_data.decode_data_uri(response.json()["base64"])
+    except (requests.exceptions.RequestException, ValueError, KeyError) as error:
+        framesLogger.warning(f"Failed to get frame {date} {hour}: {error}")
+        return None
+
+    frame = Frame(region, date, hour, image)
+    frameStore.put(frame)
+    return frame
+
+
+def get_frames(keys):
+    """Get frames from `frameStore`, downloading the missing ones concurrently.
+
+    Parameters
+    --------
+    keys : list : tuple
+        (region, date, hour) of each frame.
+
+    Returns
+    --------
+    frames : list : Frame
+        The frames, in the same order as `keys`. Frames that couldn't be downloaded are left out.
+    """
+
+    frames = {key: frameStore.get(key) for key in keys}
+    missingKeys = [key for key, frame in frames.items() if frame is None]
+    if missingKeys:
+        framesLogger.debug(f"Downloading {len(missingKeys)} missing frames.")
+        with ThreadPoolExecutor(max_workers=FRAME_FETCH_WORKERS) as executor:
+            fetchedFrames = executor.map(
+                lambda key: fetch_frame(key[1], key[2], key[0]), missingKeys
+            )
+            frames.update(zip(missingKeys, fetchedFrames))
+
+    return [frames[key] for key in keys if frames[key] is not None]
+
+
+def get_latest_frames_keys(nFrames, region=VPR_REGION):
+    """Get the (region, date, hour) of the latest `nFrames` frames available, newest first (going back to yesterday if needed)."""
+
+    utcNow = arrow.utcnow()
+    keys = []
+    for date in [utcNow, utcNow.shift(days=-1)]:
+        dateString = date.format("YYYY-MM-DD")
+        for hour in get_frame_hours(dateString, region)[: nFrames - len(keys)]:
+            keys.append((region, dateString, hour))
+        if len(keys) >= nFrames:
+            break
+    return keys
+
+
+def get_latest_frames(nFrames, region=VPR_REGION):
+    """Get the latest `nFrames` frames, newest first, from `frameStore` (downloading only those it doesn't have)."""
+
+    return get_frames(get_latest_frames_keys(nFrames, region))
+
+
+def prefetch_frames_routine(nFrames=PREFETCH_FRAMES):
+    """Download new frames into `frameStore` as soon as they are published, so commands don't have to.
+
+    Returns
+    --------
+    newFrames : bool
+        True if any new frame was downloaded, False otherwise.
+    """
+
+    keys = get_latest_frames_keys(nFrames)
+    missingKeys = [key for key in keys if key not in frameStore]
+    if missingKeys:
+        get_frames(missingKeys)
+    framesLogger.info(
+        f"Prefetched {len(missingKeys)} frames; {len(frameStore.frames)} frames "
+        f"({frameStore.nBytes / 1024 / 1024:.1f} MB) stored; stats: {frameStore.stats}"
+    )
+    return bool(missingKeys)
+
+
+framesSession = create_session()
+frameStore = FrameStore()
+frameHours = {}
+frameHoursLock = threading.Lock()
@@ -0,0 +1,204 @@
+# This file contains the scheduler that runs the bot's routines periodically, each in its own thread.
+
+import time
+import random
+import logging
+import threading
+
+schedulerLogger = logging.getLogger(__name__)
+schedulerLogger.setLevel(logging.DEBUG)
+
+
+class Routine:
+    """The Routine object runs a function periodically in its own thread.
+
+    If `maxInterval` is greater than `minInterval`, the interval adapts to the function's return value: it goes back to `minInterval` whenever the function returns True (e.g. something changed) and is multiplied by `backoff` (up to `maxInterval`) otherwise, including when it raises.
+
+    Parameters
+    ----------
+    name : str
+        Name of the routine, used in logs.
+    func : function
+        Function run by the routine, without arguments.
+    minInterval : float
+        Interval (in seconds) between runs while the function is active.
+    maxInterval : float
+        Interval (in seconds) between runs while the function is idle. Defaults to `minInterval`.
+    backoff : float
+        Factor the interval is multiplied by after each idle run. Defaults to 2.
+    jitter : float
+        Fraction of the interval randomly added or subtracted from it, so routines don't synchronize. Defaults to 0.1.
+    deadline : float
+        Time (in seconds) after which a run still going is logged as overdue. Defaults to `minInterval`.
+    lock : threading.RLock
+        Lock shared with other callers of the function (e.g. another thread); if it is held when the routine is due, the run is skipped. It must be reentrant if the function acquires it too. Defaults to None, since a routine never overlaps itself (each run is scheduled after the previous one finishes).
+
+    Attributes
+    ----------
+    interval : float
+        Current interval (in seconds) between runs.
+    stats : dict
+        Number of runs, skipped runs (`lock` held when due), errors and overdue runs; duration of the last run, mean and max durations, and lag (how late the last run started) and max lag, in seconds.
+    """
+
+    def __init__(
+        self,
+        name,
+        func,
+        minInterval,
+        maxInterval=None,
+        backoff=2,
+        jitter=0.1,
+        deadline=None,
+        lock=None,
+    ):
+        self.name = name
+        self.func = func
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval or minInterval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.deadline = deadline or minInterval
+
+        self.interval = minInterval
+        self.nextRunAt = time.monotonic()
+        self.lock = lock
+        self.stats = {
+            "nRuns": 0,
+            "nSkipped": 0,
+            "nErrors": 0,
+            "nOverdue": 0,
+            "lastDuration": 0,
+            "meanDuration": 0,
+            "maxDuration": 0,
+            "lastLag": 0,
+            "maxLag": 0,
+        }
+
+    def run(self):
+        """Run the routine once, unless its lock is held elsewhere.
+
+        Returns
+        --------
+        active : bool
+            Whether the function returned True, or None if the run was skipped.
+        """
+
+        if self.lock and not self.lock.acquire(blocking=False):
+            self.stats["nSkipped"] += 1
+            schedulerLogger.warning(f"Skipping {self.name}: it is already running.")
+            return None
+
+        overdueTimer = threading.Timer(self.deadline, self.warn_overdue)
+        overdueTimer.daemon = True
+        startTime = time.monotonic()
+        try:
+            overdueTimer.start()
+            return self.func() is True
+        except Exception as error:
+            self.stats["nErrors"] += 1
+            schedulerLogger.exception(f"Error in {self.name}: {error}")
+            return False
+        finally:
+            overdueTimer.cancel()
+            self.record_duration(time.monotonic() - startTime)
+            if self.lock:
+                self.lock.release()
+
+    def warn_overdue(self):
+        """Log that the routine is taking longer than its deadline."""
+
+        self.stats["nOverdue"] += 1
+        schedulerLogger.warning(
+            f"{self.name} has been running for more than {self.deadline}s."
+        )
+
+    def record_duration(self, duration):
+        """Record a run's duration in `stats`."""
+
+        stats = self.stats
+        stats["nRuns"] += 1
+        stats["lastDuration"] = duration
+        stats["meanDuration"] += (duration - stats["meanDuration"]) / stats["nRuns"]
+        stats["maxDuration"] = max(stats["maxDuration"], duration)
+
+    def schedule_next_run(self, active):
+        """Adapt the interval to whether the last run was active and schedule the next run, with jitter."""
+
+        if active:
+            self.interval = self.minInterval
+        else:
+            self.interval = min(self.interval * self.backoff, self.maxInterval)
+
+        jitter = self.interval * self.jitter * random.uniform(-1, 1)
+        self.nextRunAt = time.monotonic() + self.interval + jitter
+
+    def loop(self):
+        """Run the routine forever, each run scheduled after the previous one finishes."""
+
+        while True:
+            waitTime = self.nextRunAt - time.monotonic()
+            if waitTime > 0:
+                time.sleep(waitTime)
+
+            lag = time.monotonic() - self.nextRunAt
+            self.stats["lastLag"] = lag
+            self.stats["maxLag"] = max(self.stats["maxLag"], lag)
+
+            active = self.run()
+            self.schedule_next_run(active)
+            schedulerLogger.debug(
+                f"{self.name} took {self.stats['lastDuration']:.2f}s "
+                f"(lag {lag:.2f}s); next run in {self.nextRunAt - time.monotonic():.0f}s."
+            )
+
+
+class Scheduler:
+    """The Scheduler object runs routines periodically, each in its own thread, so a slow routine doesn't delay the others.
+
+    Attributes
+    ----------
+    routines : list : Routine
+        The scheduled routines.
+    """
+
+    def __init__(self):
+        self.routines = []
+
+    def every(self, name, func, minInterval, **kwargs):
+        """Schedule `func` to run every `minInterval` seconds (see `Routine` for the other arguments).
+
+        Returns
+        --------
+        routine : Routine
+            The scheduled routine.
+        """
+
+        routine = Routine(name, func, minInterval, **kwargs)
+        self.routines.append(routine)
+        return routine
+
+    def start(self):
+        """Start running every routine, each in its own daemon thread."""
+
+        for routine in self.routines:
+            routineThread = threading.Thread(
+                target=routine.loop, name=routine.name, daemon=True
+            )
+            routineThread.start()
+
+    def get_stats(self):
+        """Get the stats of every routine, keyed by name."""
+
+        return {routine.name: dict(routine.stats) for routine in self.routines}
+
+    def log_stats(self):
+        """Log the stats of every routine."""
+
+        for name, stats in self.get_stats().items():
+            schedulerLogger.info(
+                f"{name}: {stats['nRuns']} runs ({stats['nSkipped']} skipped, "
+                f"{stats['nErrors']} errors, {stats['nOverdue']} overdue); duration "
+                f"mean {stats['meanDuration']:.2f}s, max {stats['maxDuration']:.2f}s; "
+                f"max lag {stats['maxLag']:.2f}s."
+            )
@@ -1,12 +1,154 @@
 import re
 import json
+import time
+import logging
+import datetime
+import threading
+from collections import OrderedDict
+
 import requests
 
+from models import db
+from utils import cep_ranges
+
+viacepLogger = logging.getLogger(__name__)
+viacepLogger.setLevel(logging.DEBUG)
+
+# Timeout (in seconds) for requests to viacep
+VIACEP_TIMEOUT = 5
+# Maximum number of CEP lookups kept in memory
+CEP_CACHE_SIZE = 4096
+# Time (in seconds) lookups are cached for; invalid CEPs are cached for less time
+CEP_CACHE_TTL = 30 * 24 * 60 * 60
+CEP_NEGATIVE_CACHE_TTL = 24 * 60 * 60
+
+
+class CEPCache:
+    """The CEPCache object caches viacep lookups in two tiers: a size-bounded in-process LRU in front of the CEPCache collection.
+
+    Lookups of invalid CEPs (viacep's `{"erro": true}`) are cached too, for less time. Concurrent misses for the same CEP wait for a single lookup.
+
+    Parameters
+    ----------
+    maxSize : int
+        Maximum number of lookups kept in memory.
+
+    Attributes
+    ----------
+    stats : dict
+        Number of memory hits, database hits and misses (viacep requests).
+    """
+
+    def __init__(self, maxSize=CEP_CACHE_SIZE):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.pendingLookups = {}
+        self.lock = threading.Lock()
+        self.stats = {"memoryHits": 0, "databaseHits": 0, "misses": 0}
+
+    def get(self, CEPString, lookupFunc):
+        """Get lookup for `CEPString` from the cache, calling `lookupFunc(CEPString)` on a miss."""
+
+        with self.lock:
+            lookup = self.get_from_memory(CEPString)
+            if lookup is not None:
+                self.stats["memoryHits"] += 1
+                return lookup
+
+            pendingLookup = self.pendingLookups.get(CEPString)
+            if pendingLookup is None:
+                self.pendingLookups[CEPString] = threading.Event()
+
+        if pendingLookup is not None:
+            # Another thread is already looking this CEP up; wait for it
+            pendingLookup.wait(VIACEP_TIMEOUT)
+            with self.lock:
+                lookup = self.get_from_memory(CEPString)
+                if lookup is not None:
+                    self.stats["memoryHits"] += 1
+                    return lookup
+            return lookupFunc(CEPString)
+
+        try:
+            lookup = self.get_from_database(CEPString)
+            if lookup is not None:
+                self.stats["databaseHits"] += 1
+            else:
+                lookup = lookupFunc(CEPString)
+                self.stats["misses"] += 1
+                viacepLogger.debug(f"CEP cache miss for {CEPString}; stats: {self.stats}")
+                self.store_in_database(CEPString, lookup)
+
+            with self.lock:
+                self.store_in_memory(CEPString, lookup)
+            return lookup
+        finally:
+            with self.lock:
+                self.pendingLookups.pop(CEPString).set()
+
+    def get_from_memory(self, CEPString):
+        """Get lookup from the in-process LRU (must be called holding `lock`)."""
+
+        entry = self.entries.get(CEPString)
+        if entry is None:
+            return None
+
+        expiresAt, lookup = entry
+        if time.time() > expiresAt:
+            del self.entries[CEPString]
+            return None
+
+        self.entries.move_to_end(CEPString)
+        return lookup
+
+    def store_in_memory(self, CEPString, lookup):
+        """Store lookup in the in-process LRU, evicting the least recently used one if full (must be called holding `lock`)."""
+
+        self.entries[CEPString] = (time.time() + get_cache_ttl(lookup), lookup)
+        self.entries.move_to_end(CEPString)
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def get_from_database(self, CEPString):
+        """Get lookup from the CEPCache collection."""
+
+        cachedLookup = db.INMETBotDB.cepCacheCollection.find_one({"_id": CEPString})
+        if cachedLookup:
+            return cachedLookup["lookup"]
+        return None
+
+    def store_in_database(self, CEPString, lookup):
+        """Store lookup in the CEPCache collection, which expires it through a TTL index."""
+
+        expiresAt = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=get_cache_ttl(lookup)
+        )
+        db.INMETBotDB.cepCacheCollection.replace_one(
+            {"_id": CEPString},
+            {"_id": CEPString, "lookup": lookup, "expiresAt": expiresAt},
+            upsert=True,
+        )
+
+
+def get_cache_ttl(lookup):
+    """Get for how long (in seconds) a lookup should be cached."""
+
+    if lookup.get("erro"):
+        return CEP_NEGATIVE_CACHE_TTL
+    return CEP_CACHE_TTL
+
+
+cepCache = CEPCache()
+
 
 def get_cep_IBGE(CEPString):
-    """Lookup CEP's IBGE code."""
+    """Lookup CEP's IBGE code, from the offline CEP ranges table if it has the CEP."""
 
     if CEPString:
+        location = offline_lookup(CEPString)
+        if location:
+            return location["IBGE"]
+
         lookup = cep_lookup(CEPString)
         if lookup:
             return lookup["ibge"]
@@ -17,9 +159,13 @@ def get_cep_IBGE(CEPString):
 
 
 def get_cep_city(CEPString):
-    """Lookup CEP's city."""
+    """Lookup CEP's city, from the offline CEP ranges table if it has the CEP."""
 
     if CEPString:
+        location = offline_lookup(CEPString)
+        if location:
+            return location["city"]
+
         lookup = cep_lookup(CEPString)
         if lookup:
             return lookup["localidade"]
@@ -29,15 +175,66 @@ def get_cep_city(CEPString):
         return None
 
 
+def get_cep_location(CEPString):
+    """Lookup CEP's city and IBGE code with a single request (or none, if the offline CEP ranges table has the CEP).
+
+    Returns
+    --------
+    location : dict
+        {"CEP", "city", "IBGE"} for the CEP.
+    """
+
+    if CEPString:
+        location = offline_lookup(CEPString)
+        if location:
+            return location
+
+        lookup = cep_lookup(CEPString)
+        if lookup:
+            return {
+                "CEP": CEPString,
+                "city": lookup["localidade"],
+                "IBGE": lookup["ibge"],
+            }
+        else:
+            raise KeyError
+    else:
+        return None
+
+
+def offline_lookup(CEPString):
+    """Lookup CEP's city and IBGE code in the offline CEP ranges table.
+
+    Returns
+    --------
+    location : dict
+        {"CEP", "city", "IBGE"} for the CEP, or None if it isn't in the table.
+    """
+
+    if matchCepRegex(CEPString):
+        cepRange = cep_ranges.lookup_cep(cepReplace(CEPString)[:8])
+        if cepRange:
+            city, UF, IBGE = cepRange
+            return {"CEP": CEPString, "city": city, "IBGE": IBGE}
+    return None
+
+
 def cep_lookup(CEPString):
-    """CEP lookup with viacep's API."""
+    """CEP lookup with viacep's API, cached by `cepCache`."""
 
     if matchCepRegex(CEPString):
-        return json.loads(requests.get(viacep_request(CEPString)).content)
+        return cepCache.get(cepReplace(CEPString), viacep_lookup)
     else:
         return None
 
 
+def viacep_lookup(CEPString):
+    """CEP lookup with viacep's API, without caching."""
+
+    response = requests.get(viacep_request(CEPString), timeout=VIACEP_TIMEOUT)
+    return json.loads(response.content)
+
+
 def viacep_request(CEPString):
     """Make a request to the viacep's API with given CEP."""
 